@@ -1,5 +1,12 @@
 import pygame
 import sys
+import os
+import time
+import argparse
+import struct
+import bisect
+import mmap
+from collections import namedtuple
 from pygame.locals import *
 
 ####################################
@@ -33,6 +40,8 @@ flowerColor = [200, 50, 10]
 
 # Tiles
 tileWidth = 50
+chunkColumns = 25 # columns pre-rendered together, about one screen wide
+drawMargin = tileWidth # how far outside the view things are still drawn
 blankTile = ' '
 groundTile = 'g'
 marioTile = 'm'
@@ -46,12 +55,48 @@ qMushTile = '1'
 qOneUpTile = '2'
 qStarTile = '*'
 
+# Compiled levels
+# Header, then a file offset per column, the spawn and block tables and
+# finally each column's tiles as runs of (tile, count) from the top.
+levelMagic = b"SMBL"
+levelHeader = struct.Struct("<4sBHHHH") # magic, version, columns, rows, spawns, blocks
+levelOffset = struct.Struct("<I")
+levelItem = struct.Struct("<HHc") # column, row, tile
+levelRun = struct.Struct("<cB") # tile, rows
+spawnTiles = [marioTile, goombaTile, koopaTile]
+contentTiles = [bCoinTile, qCoinTile, qMushTile, qOneUpTile, qStarTile]
+runTiles = [groundTile, pipeTile, blockTile]
+mergedTiles = [groundTile, pipeTile] # static tiles merged into larger rectangles as chunks load
+
 # Physics
 gravity = 0.02
 maxVelocity = 1
+sweepDistance = tileWidth / 2 # solid entities moving further in a step are swept against the tiles
 marioWalk = 0.5
 marioRun = 1.0
 
+# Items
+# Coins and mushrooms are made once per level and reused. Each role has
+# this many, the most that can be out at once.
+itemPools = [("coin", 8), ("super", 2), ("1up", 2)]
+
+# Simulation
+fixedStepRate = 60 # physics steps per second in fixed-timestep mode
+maxCatchUpSteps = 5
+simulationMargin = 8 * tileWidth # how far outside the view entities are still simulated
+
+# Controls
+controlKeys = [K_a, K_d, K_s, K_SPACE, K_LSHIFT]
+controlBits = dict((key, 1 << i) for i, key in enumerate(controlKeys))
+recordingHeader = struct.Struct("<4sBf") # magic, version, steps per second
+recordingRun = struct.Struct("<HB") # frames, buttons
+
+# Collisions
+sideLeft = 1
+sideRight = 2
+sideTop = 4
+sideBottom = 8
+
 ####################################
 # Classes
 ####################################
@@ -63,25 +108,48 @@ class Camera:
         self.y = 0
         self.w = screenSize[0]
         self.h = screenSize[1]
+        self.lastX = None
+        self.drawX = 0
+        self.drawY = 0
         self.getValues()
 
     def reset (self):
         self.x = 0
         self.y = 0
+        self.lastX = None
+
+    def savePosition (self):
+        self.lastX = self.x
+
+    def canSee (self, x, w):
+        return x + w > self.drawX - drawMargin and x < self.drawX + self.w + drawMargin
+
+    def setDrawValues (self, alpha):
+        # Place the view between the last two physics steps.
+        self.drawX = self.x
+        self.drawY = self.y
+        if self.lastX is not None:
+            self.drawX = self.lastX + (self.x - self.lastX) * alpha
 
     def update (self):
         self.getValues()
 
     def getValues (self):
-        mario = level.getMario()
-        if mario is None:
+        # Follow whichever player is furthest ahead.
+        players = level.getPlayers()
+        if not players:
             return
-        if mario.x > self.x + self.w/2 - mario.w/2:
-            self.x = level.getMario().x - screenSize[0]/2 + tileWidth/2
+        lead = players[0]
+        for mario in players:
+            if mario.x > lead.x:
+                lead = mario
+        if lead.x > self.x + self.w/2 - lead.w/2:
+            self.x = lead.x - screenSize[0]/2 + tileWidth/2
 
         # Make sure mario doesn't move off-screen to the left
-        if mario.x < self.x:
-            mario.x = self.x
+        for mario in players:
+            if mario.x < self.x:
+                mario.x = self.x
 
 # Hud
 class HUD (object):
@@ -97,6 +165,13 @@ class HUD (object):
         self.worldString = "WORLD"
         self.timeString = "TIME"
 
+        # The labels never change, so render them once. Values are
+        # composed from cached glyphs when they change.
+        self.rect = Rect(0, self.y - 25, screenSize[0], 25 + font.get_height())
+        self.glyphs = GlyphAtlas(font, white)
+        self.labels = [(font.render(label, False, white), (x, self.y - 25)) for label, x in [(self.marioString, self.scoreX), (self.worldString, self.worldX), (self.timeString, self.timeX)]]
+        self.fields = {}
+
     def reset (self):
         self.score = 0
         self.coins = 0
@@ -118,56 +193,286 @@ class HUD (object):
             camera.reset()
             self.reset()
             
+    def field (self, name, value, text):
+        # Only compose a field again when its value changed.
+        cached = self.fields.get(name)
+        if cached is None or cached[0] != value:
+            cached = (value, self.glyphs.render(text))
+            self.fields[name] = cached
+        return cached[1]
+
+    def fieldValues (self):
+        return [("score", self.score, "%08d"%self.score, self.scoreX),
+                ("coins", self.coins, "O x %02d"%self.coins, self.coinsX),
+                ("world", self.world, self.world, self.worldX),
+                ("time", self.timeRemaining, str(self.timeRemaining), self.timeX)]
+
+    def changedAreas (self):
+        # Screen areas of the fields that will look different when drawn.
+        areas = []
+        for name, value, text, x in self.fieldValues():
+            cached = self.fields.get(name)
+            if cached is None or cached[0] != value:
+                w = font.size(text)[0]
+                if cached is not None:
+                    w = max(w, cached[1].get_width())
+                areas.append(Rect(x, self.y, w, font.get_height()))
+        return areas
+
     def draw (self):
-        # Score
-        ren = font.render(self.marioString, False, white)
-        screen.blit(ren, (self.scoreX, self.y - 25))
-        scoreString = "%08d"%self.score
-        ren = font.render(scoreString, False, white)
-        screen.blit(ren, (self.scoreX, self.y))
-
-        # Coins
-        coinString = "O x %02d"%self.coins
-        ren = font.render(coinString, False, white)
-        screen.blit(ren, (self.coinsX, self.y))
-
-        # World
-        ren = font.render(self.worldString, False, white)
-        screen.blit(ren, (self.worldX, self.y - 25))
-        ren = font.render(self.world, False, white)
-        screen.blit(ren, (self.worldX, self.y))
-
-        # Time
-        ren = font.render(self.timeString, False, white)
-        screen.blit(ren, (self.timeX, self.y - 25))
-        ren = font.render(str(self.timeRemaining), False, white)
-        screen.blit(ren, (self.timeX, self.y))
-
-# Struct
-class Struct (object):
-    def __init__ (self, **entries):
-        self.__dict__.update(entries)
+        for ren, position in self.labels:
+            screen.blit(ren, position)
+
+        # Score, coins, world and time
+        for name, value, text, x in self.fieldValues():
+            screen.blit(self.field(name, value, text), (x, self.y))
+
+# GlyphAtlas
+# Each character is rasterized once; strings are composed by blitting
+# the cached glyphs at the pen positions the font reports.
+class GlyphAtlas (object):
+    def __init__ (self, font, color):
+        self.font = font
+        self.color = color
+        self.glyphs = {}
+
+    def glyph (self, char):
+        ren = self.glyphs.get(char)
+        if ren is None:
+            ren = self.font.render(char, False, self.color)
+            self.glyphs[char] = ren
+        return ren
+
+    def render (self, text):
+        surface = pygame.Surface(self.font.size(text), SRCALPHA)
+        for i in range(len(text)):
+            surface.blit(self.glyph(text[i]), (self.font.size(text[:i])[0], 0))
+        return surface
+
+# DirtyRects
+# Redraws only the parts of the screen that changed since the last frame
+# and pushes just those to the display. Falls back to a full redraw when
+# the camera moves.
+class DirtyRects (object):
+    def __init__ (self):
+        self.drawn = {}
+        self.camera = None
+        self.cameraX = None
+
+    def objectRects (self):
+        # Where everything that moves was drawn this frame, in screen space.
+        rects = {}
+        left = camera.drawX - drawMargin
+        right = camera.drawX + camera.w + drawMargin
+        for entity in level.entityIndex.query(left, right):
+            if entity.isVisible():
+                x, y = entity.drawPosition()
+                rects[entity] = Rect(x - camera.drawX, y - camera.drawY, entity.w, entity.h)
+        for tile in level.animatedTiles:
+            if isinstance(tile, BrickBlock) and tile.destroyed:
+                for i, piece in enumerate(tile.currState.tiny):
+                    rects[(tile, i)] = Rect(piece.x - camera.drawX, piece.y - camera.drawY, piece.w, piece.h)
+            elif tile.isVisible():
+                rects[tile] = Rect(tile.x - camera.drawX, tile.y - camera.drawY, tile.w, tile.h)
+        return rects
+
+    def render (self):
+        rects = self.objectRects()
+        changedTiles = list(level.changedRects)
+        del level.changedRects[:]
+
+        if camera is not self.camera or camera.drawX != self.cameraX:
+            self.camera = camera
+            self.cameraX = camera.drawX
+            self.drawn = rects
+            screen.fill(screenBGColor)
+            level.draw()
+            hud.draw()
+            pygame.display.flip()
+            return
+
+        dirty = []
+        for obj, rect in rects.items():
+            old = self.drawn.pop(obj, None)
+            if old is None:
+                dirty.append(rect)
+            elif old != rect:
+                dirty.append(old.union(rect))
+        dirty.extend(self.drawn.values())
+        for rect in changedTiles:
+            dirty.append(rect.move(-camera.drawX, -camera.drawY))
+        dirty.extend(hud.changedAreas())
+        self.drawn = rects
+
+        screenRect = screen.get_rect()
+        dirty = [rect.inflate(2, 2).clip(screenRect) for rect in dirty]
+        dirty = [rect for rect in dirty if rect.w > 0 and rect.h > 0]
+        for rect in dirty:
+            screen.set_clip(rect)
+            screen.fill(screenBGColor, rect)
+            level.draw(rect)
+            if rect.colliderect(hud.rect):
+                hud.draw()
+        screen.set_clip(None)
+        pygame.display.update(dirty)
+
+# InputFrame
+# The buttons held for one step. Indexed with pygame key constants, like
+# the list returned by pygame.key.get_pressed().
+class InputFrame (object):
+    def __init__ (self, mask=0):
+        self.mask = mask
+
+    def __getitem__ (self, key):
+        bit = controlBits.get(key)
+        return bit is not None and self.mask & bit != 0
+
+# Controls
+# Polls the input source once per step so every state reads the same
+# snapshot.
+class Controls (object):
+    def __init__ (self, source):
+        self.source = source
+        self.frame = InputFrame()
+
+    def poll (self):
+        self.frame.mask = self.source.read()
+
+    def finished (self):
+        return self.source.finished()
+
+    def close (self):
+        self.source.close()
+
+# KeyboardInput
+class KeyboardInput (object):
+    def read (self):
+        pressed = pygame.key.get_pressed()
+        mask = 0
+        for key in controlKeys:
+            if pressed[key]:
+                mask |= controlBits[key]
+        return mask
+
+    def finished (self):
+        return False
+
+    def close (self):
+        return
+
+# ScriptedInput
+# Plays back any iterable of button masks, e.g. a generator.
+class ScriptedInput (object):
+    def __init__ (self, masks):
+        self.masks = iter(masks)
+        self.done = False
+
+    def read (self):
+        try:
+            return next(self.masks)
+        except StopIteration:
+            self.done = True
+            return 0
+
+    def finished (self):
+        return self.done
+
+    def close (self):
+        return
+
+# ReplayInput
+# Plays back a file written by InputRecorder.
+class ReplayInput (object):
+    def __init__ (self, fileName):
+        with open(fileName, "rb") as f:
+            data = f.read()
+        magic, version, self.rate = recordingHeader.unpack_from(data, 0)
+        if magic != b"SMBI" or version != 1:
+            raise ValueError("%s is not an SMB input recording" % fileName)
+        self.runs = []
+        for offset in range(recordingHeader.size, len(data), recordingRun.size):
+            self.runs.append(recordingRun.unpack_from(data, offset))
+        self.run = 0
+        self.left = self.runs[0][0] if self.runs else 0
+
+    def read (self):
+        while self.left == 0:
+            if self.run + 1 >= len(self.runs):
+                return 0
+            self.run += 1
+            self.left = self.runs[self.run][0]
+        self.left -= 1
+        return self.runs[self.run][1]
+
+    def finished (self):
+        return self.left == 0 and self.run + 1 >= len(self.runs)
+
+    def close (self):
+        return
+
+# InputRecorder
+# Passes another source through and saves what it read as runs of
+# identical button masks.
+class InputRecorder (object):
+    def __init__ (self, source, fileName, rate):
+        self.source = source
+        self.fileName = fileName
+        self.rate = rate
+        self.runs = []
+
+    def read (self):
+        mask = self.source.read()
+        if self.runs and self.runs[-1][1] == mask and self.runs[-1][0] < 0xFFFF:
+            self.runs[-1][0] += 1
+        else:
+            self.runs.append([1, mask])
+        return mask
+
+    def finished (self):
+        return self.source.finished()
+
+    def close (self):
+        with open(self.fileName, "wb") as f:
+            f.write(recordingHeader.pack(b"SMBI", 1, self.rate))
+            for frames, mask in self.runs:
+                f.write(recordingRun.pack(frames, mask))
+        self.source.close()
+
+# Sides
+# Which sides of a rect touch another. There is one immutable instance
+# for each combination, looked up by side bitmask.
+Sides = namedtuple("Sides", ["left", "right", "top", "bottom"])
+sidesByMask = [Sides(bool(mask & sideLeft), bool(mask & sideRight), bool(mask & sideTop), bool(mask & sideBottom)) for mask in range(16)]
 
 # Entity
+# Entities use __slots__; every subclass lists the attributes it adds.
 class Entity (object):
-    x = 0
-    y = 0
-    w = 0
-    h = 0
-    rect = Rect(x,y,w,h)
-    color = [0,0,0]
-    direction = "right"
-    currState = None
-    prevState = None
+    __slots__ = ["x", "y", "w", "h", "rect", "color", "direction", "dy", "velocity",
+                 "allStates", "currState", "prevState", "newState", "collidingObjects", "hasCollision", "kind",
+                 "grid", "chunk", "cellX", "cellY", "awake", "frozen", "removed", "lastX", "lastY"]
+    slotNames = {}
+    contactKind = None # what collision responses know the class as
         
     def __init__ (self, x, y, w, h, color):
+        if self.contactKind not in contactKinds:
+            raise ValueError("%s has no collision response kind" % self.__class__.__name__)
+        self.kind = self.contactKind # changes when an enemy is knocked out
+        self.grid = None # tiles only: the level's tile grid
+        self.chunk = None
+        self.awake = False # tiles only: whether the level updates it this step
+        self.frozen = False # outside the simulation window
+        self.removed = False # taken out of the level, contacts with it are stale
+        self.lastX = None
+        self.lastY = None
         self.x = x
         self.y = y
         self.w = w
         self.h = h
         self.color = color
+        self.direction = "right"
         self.rect = Rect(x,y,w,h)
-        self.allStates = {}
+        self.currState = None
+        self.prevState = None
         self.collidingObjects = []
         self.hasCollision = False
 
@@ -181,10 +486,17 @@ class Entity (object):
         return self.y
     def setY (self, y):
         self.y = y
-        self.rect = Rect(self.x, self.y, self.w, self.h)
+        self.updateRect()
     def setX (self, x):
         self.x = x
-        self.rect = Rect(self.x, self.y, self.w, self.h)
+        self.updateRect()
+
+    def updateRect (self):
+        self.rect.update(self.x, self.y, self.w, self.h)
+
+        # Keep the tile grid in step with a bumped block.
+        if self.grid is not None:
+            self.grid.move(self)
 
     def translate (self, dx, dy):
         if dx < 0:
@@ -192,13 +504,65 @@ class Entity (object):
         elif dx > 0:
             self.direction = "right"
 
-        self.x += dx
+        if (abs(dx) > sweepDistance or abs(dy) > sweepDistance) and self.isSolid():
+            self.x, self.y = self.sweep(dx, dy)
+        else:
+            self.x += dx
+            self.y += dy
 
         if isinstance(self, Mario) and self.x < 0:
             self.x = 0
         
-        self.y += dy
-        self.rect = Rect(self.x,self.y,self.w,self.h)
+        self.updateRect()
+
+    def sweep (self, dx, dy):
+        # Where a move by (dx, dy) ends. At the first tile the box would
+        # pass into it slides along the tile for the rest of the move and
+        # ends one pixel inside, so the next collision check sees the contact.
+        x, y, tile, alongX = self.sweepFrom(self.x, self.y, dx, dy)
+        if tile is None:
+            return x, y
+        if alongX:
+            x, y = self.sweepFrom(x, y, 0, self.y + dy - y)[:2]
+            return x + (1 if dx > 0 else -1), y
+        x, y = self.sweepFrom(x, y, self.x + dx - x, 0)[:2]
+        return x, y + (1 if dy > 0 else -1)
+
+    def sweepFrom (self, x, y, dx, dy):
+        # The position where the box at (x, y) first touches a tile on its
+        # way by (dx, dy), that tile, and whether it was met along x.
+        area = Rect(min(x, x + dx), min(y, y + dy), self.w + abs(dx), self.h + abs(dy)).inflate(2, 2)
+        first = 1.0
+        hit = None
+        for tile in level.tileGrid.query(area):
+            overlapX = min(x + self.w, tile.x + tile.w) - max(x, tile.x)
+            overlapY = min(y + self.h, tile.y + tile.h) - max(y, tile.y)
+            if overlapX > 0 and overlapY > 0:
+                # Already inside this tile, e.g. from the last sweep. Only
+                # moving further in across the shallower side counts.
+                alongX = overlapX < overlapY
+                if alongX:
+                    deeper = dx * (tile.x + tile.w / 2.0 - x - self.w / 2.0) > 0
+                else:
+                    deeper = dy * (tile.y + tile.h / 2.0 - y - self.h / 2.0) > 0
+                if deeper:
+                    first = 0
+                    hit = (tile, alongX)
+                continue
+
+            xEntry, xExit = sweepInterval(x, self.w, dx, tile.x, tile.w)
+            yEntry, yExit = sweepInterval(y, self.h, dy, tile.y, tile.h)
+            entry = max(xEntry, yEntry)
+            if 0 <= entry < first and entry < min(xExit, yExit):
+                first = entry
+                hit = (tile, xEntry > yEntry)
+
+        if hit is None:
+            return x + dx, y + dy, None, None
+        tile, alongX = hit
+        if alongX:
+            return (tile.x - self.w if dx > 0 else tile.x + tile.w), y + dy * first, tile, True
+        return x + dx * first, (tile.y - self.h if dy > 0 else tile.y + tile.h), tile, False
 
     def changeState (self, stateID):
         if self.allStates.get(stateID) is None:
@@ -210,20 +574,121 @@ class Entity (object):
             self.currState = self.newState
             self.currState.enterState(self)
 
+            # A tile's look may have changed, e.g. a block turning grey.
+            if self.chunk is not None:
+                level.tileChanged(self)
+
     def addCollision (self, collided):
+        # The list is reused; whatever it held since the last reset is
+        # stale once hasCollision is False.
+        if not self.hasCollision:
+            del self.collidingObjects[:]
         self.collidingObjects.append(collided)
         self.hasCollision = True
 
+        # A tile sleeps until something touches it.
+        if self.chunk is not None and not self.awake:
+            level.wakeTile(self)
+
+    def clone (self):
+        # A copy that is not part of any level, with its own states.
+        cls = self.__class__
+        if cls not in self.slotNames:
+            self.slotNames[cls] = [name for c in cls.__mro__ for name in c.__dict__.get("__slots__", ())]
+        entity = cls.__new__(cls)
+        for name in self.slotNames[cls]:
+            if hasattr(self, name):
+                setattr(entity, name, getattr(self, name))
+        entity.rect = Rect(self.rect)
+        entity.collidingObjects = []
+        entity.hasCollision = False
+        entity.grid = None
+        entity.chunk = None
+        entity.allStates = {}
+        for stateID, state in self.allStates.items():
+            entity.allStates[stateID] = state.__class__()
+            entity.allStates[stateID].__dict__.update(state.__dict__)
+            if state is self.currState:
+                entity.currState = entity.allStates[stateID]
+            if state is self.prevState:
+                entity.prevState = entity.allStates[stateID]
+        return entity
+
+    def savePosition (self):
+        self.lastX = self.x
+        self.lastY = self.y
+
+    def drawPosition (self):
+        # Between two fixed physics steps draw the entity renderAlpha of
+        # the way from its last position. Teleports are not smoothed.
+        if self.lastX is None or abs(self.x - self.lastX) > tileWidth or abs(self.y - self.lastY) > tileWidth:
+            return self.x, self.y
+        return self.lastX + (self.x - self.lastX) * renderAlpha, self.lastY + (self.y - self.lastY) * renderAlpha
+
+    def isAnimating (self):
+        # Tiles that are not animating are drawn into their level chunk.
+        return False
+
     def draw (self):
-        pygame.draw.rect(screen, self.color, [self.x - camera.x, self.y - camera.y, self.w, self.h], 0)
+        self.drawOn(screen, camera.drawX, camera.drawY)
+
+    def isVisible (self):
+        return True
+
+    def isSolid (self):
+        # Whether fast moves are swept so the entity can't pass through tiles.
+        return False
+
+    def role (self):
+        # The pool the level keeps the entity in, or "player".
+        return None
+
+    def despawn (self):
+        # Called once the entity is behind or below the simulation window.
+        level.removeEntity(self)
+
+    def isParked (self):
+        # Pooled items waiting off screen are frozen wherever the camera is.
+        return False
+
+    def changes (self):
+        # Tiles only: what has to be kept of the tile when its chunk is
+        # evicted, or None if it is still as the level file has it.
+        return None
+
+    def restore (self, changes):
+        # Tiles only: put back what changes() returned on a fresh tile.
+        return
+
+    def drawOn (self, surface, offsetX, offsetY):
+        if self.isVisible():
+            x, y = self.drawPosition()
+            pygame.draw.rect(surface, self.color, [x - offsetX, y - offsetY, self.w, self.h], 0)
 
 # Enemy
 class Enemy (Entity):
+    __slots__ = ["isDead", "isDeadDead", "spawn"]
+    contactKind = "enemy"
+
     def __init__ (self, x, y, w, h, color):
         Entity.__init__(self, x, y, w, h, color)
+        self.spawn = None # the level's spawn entry this enemy was made from
+
+    def isSolid (self):
+        # Enemies that were hit fall out through the floor.
+        return not self.isDead
+
+    def despawn (self):
+        # A live enemy comes back if a player respawns behind it.
+        if not self.isDead and self.spawn is not None:
+            level.passedSpawns.append(self.spawn)
+        level.removeEntity(self)
 
 # Coin
 class Coin (Entity):
+    __slots__ = ["active"]
+    contactKind = "coin"
+
     def __init__ (self, x, y, w, h, color):
         Entity.__init__(self, x, y, w, h, color)
         self.allStates = { "idle":CoinStateIdle(), "unused":CoinStateUnused() }
@@ -235,12 +700,24 @@ class Coin (Entity):
         if self.active:
             self.currState.execute(self, deltaTime)
 
-    def draw (self):
+    def isVisible (self):
+        return self.active
+
+    def role (self):
+        return "coin"
+
+    def despawn (self):
         if self.active:
-            Entity.draw(self)    
+            self.changeState("unused")
+
+    def isParked (self):
+        return not self.active
 
 # BrickBlock
 class BrickBlock (Entity):
+    __slots__ = ["destroyed", "hasCoins", "used", "numCoins"]
+    contactKind = "brick"
+
     def __init__ (self, x, y, w, h, color):
         Entity.__init__(self, x, y, w, h, color)
         self.allStates = { "idle":BrickBlockStateIdle(), "hitLight":BrickBlockStateHitLight(), "hitHard":BrickBlockStateHitHard(), "coinHit":BrickBlockStateCoinHit() }   
@@ -254,12 +731,29 @@ class BrickBlock (Entity):
     def update (self, deltaTime):
         self.currState.execute(self, deltaTime)
 
-    def draw (self):
-        if not self.destroyed:
-            Entity.draw(self)
+    def isAnimating (self):
+        return self.currState is not self.allStates.get("idle")
+
+    def isVisible (self):
+        return not self.destroyed
+
+    def changes (self):
+        if self.destroyed or self.used or self.numCoins != 8:
+            return (self.destroyed, self.used, self.numCoins)
+        return None
+
+    def restore (self, changes):
+        # Destroyed bricks are not put back, see Level.loadChunk.
+        self.destroyed, self.used, self.numCoins = changes
+        if self.used:
+            self.hasCoins = False
+            self.color = grey
 
 # QuestionBlock
 class QuestionBlock (Entity):
+    __slots__ = ["contents", "used"]
+    contactKind = "question"
+
     def __init__ (self, x, y, w, h, contents, color):
         Entity.__init__(self, x, y, w, h, color)
         self.allStates = { "idle":QuestionBlockStateIdle(), "hit":QuestionBlockStateHit() }
@@ -271,8 +765,21 @@ class QuestionBlock (Entity):
     def update (self, deltaTime):
         self.currState.execute(self, deltaTime)
 
+    def changes (self):
+        if self.used:
+            return True
+        return None
+
+    def restore (self, changes):
+        # Already used, so entering the hit state only greys it.
+        self.used = True
+        self.changeState("hit")
+
 # OneUpBlock
 class OneUpBlock (Entity):
+    __slots__ = ["contents", "used", "found"]
+    contactKind = "oneUp"
+
     def __init__ (self, x, y, w, h, contents, color):
         Entity.__init__(self, x, y, w, h, color)
         self.allStates = { "idle":OneUpBlockStateIdle(), "hit":QuestionBlockStateHit() }
@@ -285,15 +792,31 @@ class OneUpBlock (Entity):
     def update (self, deltaTime):
         self.currState.execute(self, deltaTime)
 
-    def draw (self):
-        if self.found:
-            Entity.draw(self)
+    def isVisible (self):
+        return self.found
+
+    def changes (self):
+        if self.used:
+            return True
+        return None
+
+    def restore (self, changes):
+        # Only finding the block uses it.
+        self.used = True
+        self.found = True
+        self.changeState("hit")
 
 # GroundBlock 
 class GroundBlock (Entity):
+    __slots__ = []
+    contactKind = "ground"
+    sharedStates = None # idle keeps no data, so all blocks share it
+
     def __init__ (self, x, y, w, h, color):
         Entity.__init__(self, x, y, w, h, color)
-        self.allStates = { "idle":GroundBlockStateIdle() }
+        if GroundBlock.sharedStates is None:
+            GroundBlock.sharedStates = { "idle":GroundBlockStateIdle() }
+        self.allStates = GroundBlock.sharedStates
         self.prevState = self.allStates.get("idle")
         self.currState = self.prevState
 
@@ -302,6 +825,9 @@ class GroundBlock (Entity):
 
 # Mushroom
 class Mushroom (Entity):
+    __slots__ = ["active", "mType"]
+    contactKind = "mushroom"
+
     def __init__ (self, x, y, w, h, mType, color):
         Entity.__init__(self, x, y, w, h, color)
         self.allStates = { "spawn":MushroomStateSpawn(), "move":MushroomStateMove(), "fall":MushroomStateFall() }
@@ -316,20 +842,32 @@ class Mushroom (Entity):
         if self.active:
             self.currState.execute(self, deltaTime)
 
-    def draw (self):
+    def isVisible (self):
+        return self.active
+
+    def isSolid (self):
+        return True
+
+    def role (self):
+        return self.mType
+
+    def despawn (self):
         if self.active:
-            Entity.draw(self)
+            releaseMushroom(self)
+
+    def isParked (self):
+        return not self.active
 
 # Goomba
 class Goomba (Enemy):
-    def __init__ (self, x, y, w, h, spawnX, color):
+    __slots__ = []
+
+    def __init__ (self, x, y, w, h, color):
         Enemy.__init__(self, x, y, w, h, color)
-        self.allStates = { "wait":EnemyStateWait(), "move":EnemyStateMove(), "fall":EnemyStateFall(), "stomped":GoombaStateStomped(), "hit":EnemyStateHit() }
-        self.prevState = self.allStates.get("wait")
+        self.allStates = { "move":EnemyStateMove(), "fall":EnemyStateFall(), "stomped":GoombaStateStomped(), "hit":EnemyStateHit() }
+        self.prevState = self.allStates.get("move")
         self.currState = self.prevState
-        self.spawnX = spawnX
         self.direction = "left"
-        self.isSpawned = False
         self.isDead = False
         self.isDeadDead = False #lulz
         self.velocity = 0
@@ -339,20 +877,19 @@ class Goomba (Enemy):
         if not self.isDeadDead:
             self.currState.execute(self, deltaTime)
 
-    def draw (self):
-        if self.isSpawned and not self.isDeadDead:
-            Entity.draw(self)
+    def isVisible (self):
+        return not self.isDeadDead
 
 # Koopa
 class Koopa (Enemy):
-    def __init__ (self, x, y, w, h, spawnX, color):
+    __slots__ = ["inShell"]
+
+    def __init__ (self, x, y, w, h, color):
         Enemy.__init__(self, x, y, w, h, color)
-        self.allStates = { "wait":EnemyStateWait(), "move":EnemyStateMove(), "fall":EnemyStateFall(), "stomped":KoopaStateStomped(), "shellMove":KoopaStateShellMove(), "hit":EnemyStateHit() }
-        self.prevState = self.allStates.get("wait")
+        self.allStates = { "move":EnemyStateMove(), "fall":EnemyStateFall(), "stomped":KoopaStateStomped(), "shellMove":KoopaStateShellMove(), "hit":EnemyStateHit() }
+        self.prevState = self.allStates.get("move")
         self.currState = self.prevState
-        self.spawnX = spawnX
         self.direction = "left"
-        self.isSpawned = False
         self.isDead = False
         self.isDeadDead = False 
         self.velocity = 0
@@ -363,15 +900,20 @@ class Koopa (Enemy):
         if not self.isDeadDead:
             self.currState.execute(self, deltaTime)
 
-    def draw (self):
-        if self.isSpawned and not self.isDeadDead:
-            Entity.draw(self)
+    def isVisible (self):
+        return not self.isDeadDead
 
 # Pipe
 class Pipe (Entity):
+    __slots__ = []
+    contactKind = "pipe"
+    sharedStates = None
+
     def __init__ (self, x, y, w, h, color):
         Entity.__init__(self, x, y, w, h, color)
-        self.allStates = { "idle":PipeStateIdle() }
+        if Pipe.sharedStates is None:
+            Pipe.sharedStates = { "idle":PipeStateIdle() }
+        self.allStates = Pipe.sharedStates
         self.prevState = self.allStates.get("idle")
         self.currState = self.prevState
 
@@ -380,6 +922,9 @@ class Pipe (Entity):
 
 # Mario
 class Mario (Entity):
+    __slots__ = ["speed", "isDead", "lives", "startX", "startY", "isSuper", "isCrouch"]
+    contactKind = "mario"
+
     def __init__ (self, x, y, w, h, color):
         Entity.__init__(self, x, y, w, h, color)
         self.allStates = { "idle":MarioStateIdle(), "move":MarioStateMove(), "jump":MarioStateJump(), "fall":MarioStateFall() }
@@ -414,7 +959,7 @@ class Mario (Entity):
         # Resize and set crouch = True
         self.y += self.h/2
         self.h /= 2
-        self.rect = Rect(self.x, self.y, self.w, self.h)
+        self.updateRect()
         self.isCrouch = True
 
     def tryUnCrouch (self):
@@ -424,7 +969,7 @@ class Mario (Entity):
         # Resize and set crouch = False
         self.y -= self.h
         self.h *= 2
-        self.rect = Rect(self.x, self.y, self.w, self.h)
+        self.updateRect()
         self.isCrouch = False
         
     def getSuper (self):
@@ -439,18 +984,28 @@ class Mario (Entity):
         if isSuper and not self.isSuper and not self.isCrouch:
             self.y -= self.h
             self.h *= 2
-            self.rect = Rect(self.x, self.y, self.w, self.h)
+            self.updateRect()
 
         elif not isSuper and self.isSuper and not self.isCrouch:
             self.y += self.h/2
             self.h /= 2
-            self.rect = Rect(self.x, self.y, self.w, self.h)
+            self.updateRect()
         
         self.isSuper = isSuper
         
     def update (self, deltaTime):
         self.currState.execute(self, deltaTime)
 
+    def isSolid (self):
+        return True
+
+    def role (self):
+        return "player"
+
+    def despawn (self):
+        # The camera keeps players in view and checkMario handles falls.
+        return
+
 
 # State
 class State (object):
@@ -470,7 +1025,7 @@ class MarioStateIdle (State):
         return
 
     def execute (self, entity, deltaTime):
-        key = pygame.key.get_pressed()
+        key = controls.frame
         if key[K_SPACE]:
             entity.changeState("jump")
         elif key[K_a]:
@@ -485,10 +1040,7 @@ class MarioStateIdle (State):
             entity.tryUnCrouch()
 
         if entity.hasCollision:
-            for tile in entity.collidingObjects:
-                sides = collision_sides(entity.rect, tile.rect)
-                if isinstance(tile, Enemy) and not tile.isDead and (sides.left or sides.right or sides.top):
-                    entity.removeLife()
+            respond(entity, "marioIdle")
             resetCollisions(entity)
 
     def exitState (self, entity):
@@ -500,7 +1052,7 @@ class MarioStateMove (State):
         self.run = False
     
     def execute (self, entity, deltaTime):
-        key = pygame.key.get_pressed()
+        key = controls.frame
 
         # Check for move off of any platform
         shouldFall = should_fall(entity)
@@ -542,19 +1094,7 @@ class MarioStateMove (State):
 
         # Check for move into something.
         if entity.hasCollision:
-            for tile in entity.collidingObjects:
-                if isinstance(tile.currState, EnemyStateHit):
-                    continue
-                
-                sides = collision_sides(entity.rect, tile.rect)
-                if isinstance(tile, Enemy) and (sides.left or sides.right or sides.top):
-                    # If an enemy and still alive then hurt mario.
-                    if not tile.isDead:
-                        entity.removeLife()
-                if sides.left:
-                    entity.setX(tile.x + tile.w)
-                elif sides.right:
-                    entity.setX(tile.x - entity.w)
+            respond(entity, "marioMove")
             resetCollisions(entity)
  
     def exitState (self, entity):
@@ -570,7 +1110,7 @@ class MarioStateJump (State):
 
     def execute (self, entity, deltaTime):
         # Check in-air movement.
-        key = pygame.key.get_pressed()
+        key = controls.frame
         speed = entity.speed
         jumpGravity = gravity
 
@@ -586,31 +1126,17 @@ class MarioStateJump (State):
 
         # Check collisions.
         if entity.hasCollision:
-            for tile in entity.collidingObjects:
-                if isinstance(tile.currState, EnemyStateHit):
-                    continue
-                
-                sides = collision_sides(entity.rect, tile.rect)
-                if sides.top and not isinstance(tile, Pipe) and not isinstance(tile, GroundBlock):
-                    entity.setY(tile.bottom() + (entity.y - tile.y))
-                    entity.velocity = 0
-                    entity.dy = 0
-                if sides.bottom:
-                    entity.dy = 0
-                    if isinstance(tile, Enemy) and not tile.isDead:
-                        entity.velocity = -0.15
-                    else:
-                        entity.setY(tile.top() - entity.h)
-                        entity.changeState("idle")
-                        return
-
-        # Don't go so fast that collisions are missed
+            if respond(entity, "marioJump") is not None:
+                return
+
+        # Terminal velocity. Fast moves are swept against the tiles, so
+        # this no longer has to stop collisions from being missed.
         if entity.dy > maxVelocity:
             entity.dy = maxVelocity
         else:
-            entity.dy += entity.velocity
+            entity.dy += entity.velocity * stepScale
         
-        entity.velocity += jumpGravity
+        entity.velocity += jumpGravity * stepScale
         entity.translate(self.dx * deltaTime, entity.dy * deltaTime)
 
     def exitState (self, entity):
@@ -625,7 +1151,7 @@ class MarioStateFall (State):
     
     def execute (self, entity, deltaTime):
         # Check in-air movement.
-        key = pygame.key.get_pressed()
+        key = controls.frame
         speed = entity.speed
 
         if key[K_LSHIFT]:
@@ -639,45 +1165,20 @@ class MarioStateFall (State):
 
         # Check for landing
         if entity.hasCollision:
-            for tile in entity.collidingObjects:
-                if isinstance(tile.currState, EnemyStateHit):
-                    continue
-                
-                sides = collision_sides(entity.rect, tile.rect)
-                if sides.bottom:
-                    if isinstance(tile, Enemy) and not tile.isDead:
-                        entity.dy = 0
-                        entity.velocity = -0.15
-                    else:
-                        entity.setY(tile.top() - entity.h)
-                        entity.changeState("idle")
-                        return
+            if respond(entity, "marioFall") is not None:
+                return
         
         if entity.dy > maxVelocity:
             entity.dy = maxVelocity
         else:
-            entity.dy += entity.velocity
+            entity.dy += entity.velocity * stepScale
             
-        entity.velocity += gravity
+        entity.velocity += gravity * stepScale
         entity.translate(self.dx * deltaTime, entity.dy * deltaTime)
 
     def exitState (self, entity):
         resetCollisions(entity)
 
-# EnemyStateWait
-class EnemyStateWait (State):
-    def enterState (self, entity):
-        return
-
-    def execute (self, entity, deltaTime):
-        # Wait until player reaches some X position on the
-        # level before updating and drawing this enemy instance.
-        if level.getMario().x > entity.spawnX:
-            entity.changeState("move")
-
-    def exitState(self, entity):
-        entity.isSpawned = True
-
 # EnemyStateMove
 class EnemyStateMove (State):
     def enterState (self, entity):
@@ -696,19 +1197,7 @@ class EnemyStateMove (State):
 
         # Check for move into something.
         if entity.hasCollision:
-            for tile in entity.collidingObjects:
-                sides = collision_sides(entity.rect, tile.rect)
-                
-                # That something was Mario.
-                if sides.top and isinstance(tile, Mario):
-                    entity.changeState("stomped")
-                    
-                if sides.left:
-                    entity.setX(tile.x + tile.w)
-                    entity.direction = "right"
-                elif sides.right:
-                    entity.setX(tile.x - entity.w)
-                    entity.direction = "left"
+            respond(entity, "enemyMove")
             resetCollisions(entity)
 
     def exitState(self, entity):
@@ -740,10 +1229,11 @@ class EnemyStateFall (State):
 class EnemyStateHit (State):
     def enterState (self, entity):
         entity.isDead = True
+        entity.kind = "hitEnemy"
         self.dy = -4.0
 
     def execute (self, entity, deltaTime):
-        entity.translate(0, self.dy)
+        entity.translate(0, self.dy * stepScale)
         self.dy += gravity * deltaTime
         if entity.y > camera.h:
             entity.isDeadDead = True
@@ -759,7 +1249,7 @@ class GoombaStateStomped (State):
         self.squishTime = 1000 # one second
         entity.y += entity.h/2
         entity.h /= 2
-        entity.rect = Rect(entity.x, entity.y, entity.w, entity.h)
+        entity.updateRect()
         entity.isDead = True
 
     def execute (self, entity, deltaTime):
@@ -781,7 +1271,7 @@ class KoopaStateStomped (State):
         if entity.inShell == False:
             entity.y += entity.h/2
             entity.h /= 2
-            entity.rect = Rect(entity.x, entity.y, entity.w, entity.h)
+            entity.updateRect()
         entity.inShell = True
         entity.isDead = True
 
@@ -795,22 +1285,12 @@ class KoopaStateStomped (State):
             entity.changeState("move")
             entity.y -= entity.h*2
             entity.h *= 2
-            entity.rect = Rect(entity.x, entity.y, entity.w, entity.h)
+            entity.updateRect()
             return
 
         # Otherwise check for mario hitting it in some direction.
         if entity.hasCollision:
-            for tile in entity.collidingObjects:
-                sides = collision_sides(entity.rect, tile.rect)
-                if isinstance(tile, Mario):
-                    # Decide which way to shoot shell.
-                    if tile.x <= entity.x:
-                        entity.direction = "right"
-                    else:
-                        entity.direction = "left"
-                    # Shoot shell.
-                    entity.isDead = False
-                    entity.changeState("shellMove")
+            respond(entity, "koopaStomped")
             resetCollisions(entity)
 
     def exitState (self, entity):
@@ -834,22 +1314,7 @@ class KoopaStateShellMove (State):
 
         # Check for move into something.
         if entity.hasCollision:
-            for tile in entity.collidingObjects:
-                sides = collision_sides(entity.rect, tile.rect)
-
-                if isinstance(tile, Enemy):
-                    tile.changeState("hit")
-                
-                elif sides.top and isinstance(tile, Mario):
-                    entity.changeState("stomped")
-                
-                elif sides.left:
-                    entity.setX(tile.x + tile.w)
-                    entity.direction = "right"
-                    
-                elif sides.right:
-                    entity.setX(tile.x - entity.w)
-                    entity.direction = "left"
+            respond(entity, "shellMove")
             resetCollisions(entity)
 
     def exitState(self, entity):
@@ -862,10 +1327,7 @@ class QuestionBlockStateIdle (State):
 
     def execute (self, entity, deltaTime):
         if entity.hasCollision:
-            for tile in entity.collidingObjects:
-                # If Mario jumped up and collided with block.
-                if isinstance(tile, Mario) and tile.y > entity.y:
-                    entity.changeState("hit")
+            respond(entity, "questionBlock")
             resetCollisions(entity)
 
     def exitState(self, entity):
@@ -878,11 +1340,7 @@ class OneUpBlockStateIdle (State):
 
     def execute (self, entity, deltaTime):
         if entity.hasCollision:
-            for tile in entity.collidingObjects:
-                sides = collision_sides(entity.rect, tile.rect)
-                if sides.bottom and isinstance(tile, Mario) and tile.y > entity.y:
-                    entity.changeState("hit")
-                    entity.found = True
+            respond(entity, "oneUpBlock")
             resetCollisions(entity)
 
     def exitState(self, entity):
@@ -895,28 +1353,17 @@ class QuestionBlockStateHit (State):
         if not entity.used:
             entity.used = True
             if entity.contents == "coin":
-                for obj in level.entities:
-                    if isinstance(obj, Coin):
-                        obj.setX(entity.x + 20)
-                        obj.setY(entity.y - tileWidth)
-                        obj.changeState("idle")
+                spawnCoin(entity.x + 20, entity.y - tileWidth)
 
             elif entity.contents == "mushroom":
-                for obj in level.entities:
-                    if isinstance(obj, Mushroom) and obj.mType == "super":
-                        obj.setX(entity.x)
-                        obj.setY(entity.y)
-                        obj.changeState("spawn")
+                spawnItem("super", entity.x, entity.y, "spawn")
 
             elif entity.contents == "1up":
-                for obj in level.entities:
-                    if isinstance(obj, Mushroom) and obj.mType == "1up":
-                        obj.setX(entity.x)
-                        obj.setY(entity.y)
-                        obj.changeState("spawn")
+                spawnItem("1up", entity.x, entity.y, "spawn")
                     
     def execute (self, entity, deltaTime):
-        return
+        if entity.hasCollision:
+            resetCollisions(entity)
 
     def exitState (self, entity):
         return
@@ -928,15 +1375,7 @@ class BrickBlockStateIdle (State):
 
     def execute (self, entity, deltaTime):
         if entity.hasCollision:
-            for tile in entity.collidingObjects:
-                sides = collision_sides(entity.rect, tile.rect)
-                # If Mario jumped up and collided with block.
-                if isinstance(tile, Mario) and tile.y > entity.y and entity.hasCoins:
-                    entity.changeState("coinHit")
-                elif isinstance(tile, Mario) and tile.y > entity.y and not tile.isSuper:
-                    entity.changeState("hitLight")
-                elif isinstance(tile, Mario) and tile.y > entity.y and tile.isSuper:
-                    entity.changeState("hitHard")
+            respond(entity, "brickBlock")
             resetCollisions(entity)
 
     def exitState(self, entity):
@@ -954,12 +1393,8 @@ class BrickBlockStateCoinHit (State):
         if not entity.used and entity.hasCoins:
             if not self.tookCoin:
                 # Spawn coin
-                for obj in level.entities:
-                    if isinstance(obj, Coin):
-                        obj.setX(entity.x + 20)
-                        obj.setY(entity.y - tileWidth)
-                        obj.changeState("idle")
-                    
+                spawnCoin(entity.x + 20, entity.y - tileWidth)
+
                 # Update coins left in block
                 entity.numCoins -= 1
                 self.tookCoin = True
@@ -1029,8 +1464,8 @@ class BrickBlockStateHitHard:
         self.tiny[3].x += 0.05 * deltaTime
         self.tiny[3].y += self.bottomStep * deltaTime
 
-        self.topStep += gravity
-        self.bottomStep += gravity
+        self.topStep += gravity * stepScale
+        self.bottomStep += gravity * stepScale
             
         # Check if done
         y1 = self.tiny[0].y
@@ -1044,7 +1479,8 @@ class BrickBlockStateHitHard:
 
     def draw (self):
         for piece in self.tiny:
-            pygame.draw.rect(screen, brickBrown, [piece.x - camera.x, piece.y - camera.y, self.tinySize, self.tinySize], 0)
+            if camera.canSee(piece.x, piece.w):
+                pygame.draw.rect(screen, brickBrown, [piece.x - camera.drawX, piece.y - camera.drawY, self.tinySize, self.tinySize], 0)
         
     def exitState(self, entity):
         return
@@ -1055,7 +1491,8 @@ class GroundBlockStateIdle (State):
         return
 
     def execute (self, entity, deltaTime):
-        return
+        if entity.hasCollision:
+            resetCollisions(entity)
         
     def exitState(self, entity):
         return
@@ -1095,6 +1532,7 @@ class CoinStateUnused (State):
        entity.setX(-100)
        entity.setY(0)
        entity.active = False
+       level.parkItem(entity)
 
     def execute (self, entity, deltaTime):
         return
@@ -1136,21 +1574,8 @@ class MushroomStateMove (State):
 
         # Check for move into something.
         if entity.hasCollision:
-            for tile in entity.collidingObjects:
-                if isinstance(tile, Coin) or isinstance(tile, Enemy):
-                    return
-                
-                sides = collision_sides(entity.rect, tile.rect)
-
-                checkMushroomMarioCollision(entity, tile)
-                
-                if sides.left:
-                    entity.setX(tile.x + tile.w)
-                    entity.direction = "right"
-                    
-                elif sides.right:
-                    entity.setX(tile.x - entity.w)
-                    entity.direction = "left"
+            if respond(entity, "mushroomMove") is not None:
+                return
             resetCollisions(entity)
 
     def exitState(self, entity):
@@ -1174,48 +1599,673 @@ class MushroomStateFall (State):
         # Check land
         if landed:
             entity.changeState("move")
+        elif entity.y > camera.h:
+            releaseMushroom(entity)
+            return
 
         # Check mario pick-up in air
         if entity.hasCollision:
-            for tile in entity.collidingObjects:
-                if isinstance(tile, Coin) or isinstance(tile, Enemy):
-                    return
-                
-                checkMushroomMarioCollision(entity, tile)
+            respond(entity, "mushroomFall")
 
     def exitState(self, entity):
         return
 
+####################################
+# Contacts
+####################################
+
+# Collision responses
+# What happens when an entity touches another is looked up by the
+# responding rule set, the other entity's kind and the side mask of the
+# contact. Each rule set below is a function of (kind, sides) that
+# returns the handlers for that contact in order; they are expanded into
+# the collisionResponses table once at startup, so respond() only indexes
+# it. Handlers are called with the entity, the other one and how far
+# the entity overlaps it along the axis of the contact. A handler returns
+# something other than None to end the responses for that step.
+contactKinds = ["mario", "enemy", "hitEnemy", "coin", "mushroom", "brick", "question", "oneUp", "ground", "pipe"]
+enemyKinds = frozenset(["enemy", "hitEnemy"])
+itemStoppers = frozenset(["coin", "enemy", "hitEnemy"]) # end a mushroom's responses
+floorKinds = frozenset(["ground", "pipe"]) # a jump keeps going when its top meets these
+
+def ignoreRest (entity, tile, depth):
+    return False
+
+def pushRight (entity, tile, depth):
+    entity.setX(entity.x + depth)
+
+def pushLeft (entity, tile, depth):
+    entity.setX(entity.x - depth)
+
+def turnRight (entity, tile, depth):
+    entity.setX(entity.x + depth)
+    entity.direction = "right"
+
+def turnLeft (entity, tile, depth):
+    entity.setX(entity.x - depth)
+    entity.direction = "left"
+
+def landOn (entity, tile, depth):
+    entity.setY(tile.top() - entity.h)
+    entity.changeState("idle")
+    entity.hasCollision = False
+    return True
+
+def hurtMario (mario, enemy, depth):
+    if not enemy.isDead:
+        mario.removeLife()
+
+def bumpHead (mario, tile, depth):
+    mario.setY(tile.bottom() + (mario.y - tile.y))
+    mario.velocity = 0
+    mario.dy = 0
+
+def stopFalling (mario, tile, depth):
+    mario.dy = 0
+
+def landMario (mario, tile, depth):
+    mario.setY(tile.top() - mario.h)
+    mario.changeState("idle")
+    return True
+
+def bounceOffEnemy (mario, enemy, depth):
+    # Landing on a live enemy bounces; a dead one is just ground.
+    if enemy.isDead:
+        return landMario(mario, enemy, depth)
+    mario.dy = 0
+    mario.velocity = -0.15
+
+def stomped (enemy, mario, depth):
+    enemy.changeState("stomped")
+
+def kickShell (koopa, mario, depth):
+    # Shoot the shell away from whichever side Mario came from.
+    if mario.x <= koopa.x:
+        koopa.direction = "right"
+    else:
+        koopa.direction = "left"
+    koopa.isDead = False
+    koopa.changeState("shellMove")
+
+def knockOut (shell, enemy, depth):
+    enemy.changeState("hit")
+
+def hitBlock (block, mario, depth):
+    # Only Mario jumping up into the block hits it.
+    if mario.y > block.y:
+        block.changeState("hit")
+
+def findBlock (block, mario, depth):
+    if mario.y > block.y:
+        block.changeState("hit")
+        block.found = True
+
+def hitBrick (block, mario, depth):
+    if mario.y > block.y:
+        if block.hasCoins:
+            block.changeState("coinHit")
+        elif not mario.isSuper:
+            block.changeState("hitLight")
+        else:
+            block.changeState("hitHard")
+
+def collectMushroom (mushroom, mario, depth):
+    if mushroom.mType == "super":
+        mario.setSuper(True)
+
+    elif mushroom.mType == "1up":
+        mario.addLife()
+
+    releaseMushroom(mushroom)
+
+def marioIdleRules (kind, sides):
+    if kind == "enemy" and (sides.left or sides.right or sides.top):
+        return [hurtMario]
+    return []
+
+def marioMoveRules (kind, sides):
+    # Enemies knocked out by a shell are passed through.
+    if kind == "hitEnemy":
+        return []
+    handlers = []
+    if kind == "enemy" and (sides.left or sides.right or sides.top):
+        handlers.append(hurtMario)
+    if sides.left:
+        handlers.append(pushRight)
+    elif sides.right:
+        handlers.append(pushLeft)
+    return handlers
+
+def marioJumpRules (kind, sides):
+    if kind == "hitEnemy":
+        return []
+    handlers = []
+    if sides.top and kind not in floorKinds:
+        handlers.append(bumpHead)
+    if sides.bottom:
+        handlers.append(stopFalling)
+        handlers.append(bounceOffEnemy if kind == "enemy" else landMario)
+    return handlers
+
+def marioFallRules (kind, sides):
+    if kind == "hitEnemy" or not sides.bottom:
+        return []
+    return [bounceOffEnemy if kind == "enemy" else landMario]
+
+def enemyMoveRules (kind, sides):
+    handlers = []
+    if sides.top and kind == "mario":
+        handlers.append(stomped)
+    if sides.left:
+        handlers.append(turnRight)
+    elif sides.right:
+        handlers.append(turnLeft)
+    return handlers
+
+def koopaStompedRules (kind, sides):
+    if kind == "mario":
+        return [kickShell]
+    return []
+
+def shellMoveRules (kind, sides):
+    if kind in enemyKinds:
+        return [knockOut]
+    elif sides.top and kind == "mario":
+        return [stomped]
+    elif sides.left:
+        return [turnRight]
+    elif sides.right:
+        return [turnLeft]
+    return []
+
+def questionBlockRules (kind, sides):
+    if kind == "mario":
+        return [hitBlock]
+    return []
+
+def oneUpBlockRules (kind, sides):
+    if kind == "mario" and sides.bottom:
+        return [findBlock]
+    return []
+
+def brickBlockRules (kind, sides):
+    if kind == "mario":
+        return [hitBrick]
+    return []
+
+def mushroomMoveRules (kind, sides):
+    # Coins and enemies stop the mushroom checking any further contacts.
+    if kind in itemStoppers:
+        return [ignoreRest]
+    handlers = []
+    if kind == "mario":
+        handlers.append(collectMushroom)
+    if sides.left:
+        handlers.append(turnRight)
+    elif sides.right:
+        handlers.append(turnLeft)
+    return handlers
+
+def mushroomFallRules (kind, sides):
+    if kind in itemStoppers:
+        return [ignoreRest]
+    if kind == "mario":
+        return [collectMushroom]
+    return []
+
+def landingRules (kind, sides):
+    # Falling things land on whatever is below them, except Mario.
+    if not sides.bottom:
+        return []
+    if kind == "mario":
+        return [ignoreRest]
+    return [landOn]
+
+contactRules = {
+    "marioIdle": marioIdleRules,
+    "marioMove": marioMoveRules,
+    "marioJump": marioJumpRules,
+    "marioFall": marioFallRules,
+    "enemyMove": enemyMoveRules,
+    "koopaStomped": koopaStompedRules,
+    "shellMove": shellMoveRules,
+    "questionBlock": questionBlockRules,
+    "oneUpBlock": oneUpBlockRules,
+    "brickBlock": brickBlockRules,
+    "mushroomMove": mushroomMoveRules,
+    "mushroomFall": mushroomFallRules,
+    "landing": landingRules,
+}
+
+def buildCollisionResponses ():
+    # responses[ruleSet][kind][mask] is the tuple of handlers to run.
+    responses = {}
+    for name, rules in contactRules.items():
+        responses[name] = {}
+        for kind in contactKinds:
+            responses[name][kind] = [tuple(rules(kind, sides)) for sides in sidesByMask]
+    return responses
+
+def respond (entity, ruleSet):
+    # Run the handlers for each of entity's contacts in turn. Returns what
+    # the handler that ended the responses returned, or None.
+    responses = collisionResponses[ruleSet]
+    for tile in entity.collidingObjects:
+        if tile.removed:
+            continue
+        mask, depth = collision_contact(entity, tile)
+        for handler in responses[tile.kind][mask]:
+            result = handler(entity, tile, depth)
+            if result is not None:
+                return result
+    return None
+
 ####################################
 # Levels
 ####################################
 
+# SpatialGrid
+# Uniform grid broadphase. Objects are bucketed into every tileWidth
+# cell their rect touches so queries only visit nearby candidates.
+class SpatialGrid (object):
+    def __init__ (self, cellSize):
+        self.cellSize = cellSize
+        self.cells = {}
+        self.spans = {}
+        self.found = [] # reused by every query
+
+    def span (self, rect):
+        size = self.cellSize
+        return (rect.left // size, rect.top // size, (rect.right - 1) // size, (rect.bottom - 1) // size)
+
+    def insert (self, obj):
+        span = self.span(obj.rect)
+        self.spans[obj] = span
+        self.addToCells(obj, span)
+
+    def remove (self, obj):
+        span = self.spans.pop(obj, None)
+        if span is not None:
+            self.removeFromCells(obj, span)
+
+    def move (self, obj):
+        span = self.span(obj.rect)
+        oldSpan = self.spans.get(obj)
+        if span == oldSpan:
+            return
+        if oldSpan is not None:
+            self.removeFromCells(obj, oldSpan)
+        self.spans[obj] = span
+        self.addToCells(obj, span)
+
+    def addToCells (self, obj, span):
+        left, top, right, bottom = span
+        for row in xrange(top, bottom + 1):
+            for col in xrange(left, right + 1):
+                cell = self.cells.get((col, row))
+                if cell is None:
+                    self.cells[(col, row)] = [obj]
+                else:
+                    cell.append(obj)
+
+    def removeFromCells (self, obj, span):
+        left, top, right, bottom = span
+        for row in xrange(top, bottom + 1):
+            for col in xrange(left, right + 1):
+                cell = self.cells.get((col, row))
+                if cell is not None and obj in cell:
+                    cell.remove(obj)
+                    if not cell:
+                        del self.cells[(col, row)]
+
+    def query (self, rect):
+        # Cells are visited row by row so tiles come back in map order.
+        # The list returned is refilled by the next query, so callers
+        # must be done with it by then.
+        left, top, right, bottom = self.span(rect)
+        found = self.found
+        del found[:]
+        for row in xrange(top, bottom + 1):
+            for col in xrange(left, right + 1):
+                cell = self.cells.get((col, row))
+                if cell is None:
+                    continue
+                for obj in cell:
+                    if obj not in found:
+                        found.append(obj)
+        return found
+
+# XIndex
+# Objects kept sorted by their left edge, so the ones in a range of x
+# are found with a binary search rather than a scan.
+class XIndex (object):
+    def __init__ (self):
+        self.objects = []
+        self.keys = []
+        self.maxWidth = 0
+
+    def add (self, obj):
+        i = bisect.bisect_right(self.keys, obj.x)
+        self.keys.insert(i, obj.x)
+        self.objects.insert(i, obj)
+        self.maxWidth = max(self.maxWidth, obj.w)
+
+    def remove (self, obj):
+        i = self.objects.index(obj)
+        del self.objects[i]
+        del self.keys[i]
+
+    def refresh (self):
+        # Insertion sort on the objects' current x, moving the keys along
+        # in place; nearly free as objects only move a little per step.
+        objects = self.objects
+        keys = self.keys
+        for i in xrange(len(objects)):
+            obj = objects[i]
+            x = obj.x
+            j = i - 1
+            while j >= 0 and keys[j] > x:
+                objects[j + 1] = objects[j]
+                keys[j + 1] = keys[j]
+                j -= 1
+            objects[j + 1] = obj
+            keys[j + 1] = x
+
+    def query (self, left, right):
+        start = bisect.bisect_left(self.keys, left - self.maxWidth)
+        end = bisect.bisect_right(self.keys, right)
+        return self.objects[start:end]
+
+# EntityPool
+# The free entities of one role. acquire hands one out, release takes it
+# back once it is parked again.
+class EntityPool (object):
+    def __init__ (self):
+        self.free = []
+
+    def acquire (self):
+        if not self.free:
+            return None
+        return self.free.pop()
+
+    def release (self, entity):
+        if entity not in self.free:
+            self.free.append(entity)
+
+# LevelChunk
+# A band of chunkColumns columns. Tiles at rest are drawn once into a
+# cached surface that is only redrawn when one of them changes.
+class LevelChunk (object):
+    def __init__ (self, index):
+        self.index = index
+        self.x = index * chunkColumns * tileWidth
+        self.w = chunkColumns * tileWidth
+        self.h = screenSize[1]
+        self.tiles = []
+        self.surface = None
+        self.dirty = True
+
+    def invalidate (self):
+        self.dirty = True
+
+    def release (self):
+        self.surface = None
+        self.dirty = True
+
+    def render (self):
+        if self.surface is None:
+            self.surface = pygame.Surface((self.w, self.h), 0, screen)
+        self.surface.fill(screenBGColor)
+        for tile in self.tiles:
+            if not tile.isAnimating():
+                tile.drawOn(self.surface, self.x, 0)
+        self.dirty = False
+
+    def draw (self):
+        if self.dirty:
+            self.render()
+        screen.blit(self.surface, (self.x - camera.drawX, -camera.drawY))
+
 # Level
 class Level:
     
     def __init__ (self, fileHandle):
         self.currentFileHandle = fileHandle
+        self.template = None
         self.reset()
 
     def reset (self):
-        self.f = open(self.currentFileHandle)
-        self.tileRows = self.f.readlines()
-        self.map = []
+        # The file is only opened once. Tiles are streamed from it a chunk
+        # of columns at a time around the camera, and later resets restore
+        # players and items from templates and forget changed blocks.
+        if self.template is None:
+            self.map = []
+            self.tiles = {}
+            self.chunks = {}
+            self.changedBlocks = {}
+            self.chunkRange = None
+            self.tileGrid = SpatialGrid(tileWidth)
+            self.below = [] # reused by tilesBelow
+            self.window = [] # reused by updateWindow
+            self.spawns = []
+            self.startRun()
+            self.load()
+            self.template = [entity.clone() for entity in self.entities]
+        else:
+            for index in list(self.chunks):
+                self.evictChunk(index)
+            self.map = []
+            self.changedBlocks = {}
+            self.chunkRange = None
+            self.startRun()
+            for entity in self.template:
+                self.addEntity(entity.clone())
+        self.streamChunks(0)
+
+    def startRun (self):
         self.entities = []
-        i = 0
-        for row in self.tileRows:
-            j = 0
-            for tile in row:
-                self.loadItem(tile, j, i)
-                j += 1
-            i += 1
-
-        # Add reusable items.
-        self.entities.append(Coin(-100, 0, 10, 30, coinColor))
-        self.entities.append(Mushroom(-100, 100, tileWidth, tileWidth, "super", mushroomColor))
-        #self.entities.append(Star(-100, 200, tileWidth, tileWidth, starColor))
-        self.entities.append(Mushroom(-100, 300, tileWidth, tileWidth, "1up", oneUpColor))
-        #self.entities.append(Flower(-100, 400, tileWidth, tileWidth, flowerColor))
+        self.pendingSpawns = self.spawns[::-1] # next spawn last
+        self.passedSpawns = []
+        self.firstDrawnChunk = 0
+        self.animatedTiles = []
+        self.awakeTiles = []
+        self.updatingTiles = [] # swapped with awakeTiles every step
+        self.changedRects = []
+        self.entityIndex = XIndex()
+        self.players = [] # the entities whose role is "player"
+        self.pools = dict((role, EntityPool()) for role, size in itemPools)
+
+    def load (self):
+        if self.isCompiled(self.currentFileHandle):
+            self.openCompiled(self.currentFileHandle)
+        else:
+            self.openText(self.currentFileHandle)
+
+        # Enemies spawn in order of the x a player has to pass.
+        self.spawns.sort()
+        self.pendingSpawns = self.spawns[::-1]
+
+        # Add reusable items. They join their pools as they are added.
+        for role, size in itemPools:
+            for i in range(size):
+                self.addEntity(self.makeItem(role))
+
+    def makeItem (self, role):
+        if role == "coin":
+            return Coin(-100, 0, 10, 30, coinColor)
+        elif role == "super":
+            return Mushroom(-100, 100, tileWidth, tileWidth, "super", mushroomColor)
+        #elif role == "star":
+        #    return Star(-100, 200, tileWidth, tileWidth, starColor)
+        elif role == "1up":
+            return Mushroom(-100, 300, tileWidth, tileWidth, "1up", oneUpColor)
+        #elif role == "flower":
+        #    return Flower(-100, 400, tileWidth, tileWidth, flowerColor)
+
+    def isCompiled (self, fileName):
+        with open(fileName, "rb") as f:
+            return f.read(len(levelMagic)) == levelMagic
+
+    def openText (self, fileName):
+        # Keep the map's rows and load only what spawns, Mario and the
+        # enemy queue, in reading order.
+        with open(fileName) as f:
+            tileRows = [row.rstrip("\n") for row in f.readlines()]
+        self.columns = max(len(row) for row in tileRows)
+        self.rows = len(tileRows)
+        self.textRows = [row.ljust(self.columns) for row in tileRows]
+        self.data = None
+        for y in range(self.rows):
+            for x in range(self.columns):
+                if self.textRows[y][x] in spawnTiles:
+                    self.loadItem(self.textRows[y][x], x, y)
+
+    def openCompiled (self, fileName):
+        # The file stays mapped; columns are read through their offsets
+        # as their chunks are streamed in.
+        with open(fileName, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.columns, self.rows, spawns, blocks = levelHeader.unpack_from(self.data, 0)
+        if magic != levelMagic or version != 1:
+            raise ValueError("%s is not a compiled SMB level" % fileName)
+        self.textRows = None
+        tablesStart = levelHeader.size + self.columns * levelOffset.size
+
+        # Block contents are few, so they are sorted into their chunks now.
+        self.blocks = {}
+        for i in range(blocks):
+            x, y, tile = levelItem.unpack_from(self.data, tablesStart + (spawns + i) * levelItem.size)
+            self.blocks.setdefault(x // chunkColumns, []).append((tile, x, y))
+
+        # Spawns are stored in reading order, the order the text
+        # loader would create them in.
+        for i in range(spawns):
+            x, y, tile = levelItem.unpack_from(self.data, tablesStart + i * levelItem.size)
+            self.loadItem(tile, x, y)
+
+    def streamChunks (self, left):
+        # Keep the chunks under the simulation window of a view starting
+        # at left loaded, and evict the rest. Entities at the edge of the
+        # window reach a little past it.
+        chunkWidth = chunkColumns * tileWidth
+        margin = options.simulation_margin + 2 * tileWidth
+        first = max(0, int((left - margin) // chunkWidth))
+        last = min(int((left + screenSize[0] + margin) // chunkWidth), (self.columns - 1) // chunkColumns)
+        if self.chunkRange == (first, last):
+            return
+        self.chunkRange = (first, last)
+        evicted = False
+        for index in list(self.chunks):
+            if index < first or index > last:
+                self.evictChunk(index)
+                evicted = True
+        if evicted:
+            self.map = [tile for tile in self.map if tile.chunk is not None]
+        for index in range(first, last + 1):
+            if index not in self.chunks:
+                self.loadChunk(index)
+
+    def loadChunk (self, index):
+        # A chunk is read from the file each time it loads, and the blocks
+        # changed before it was last evicted are changed again, so used
+        # and broken blocks stay that way.
+        self.chunks[index] = LevelChunk(index)
+        self.readChunk(index)
+        changed = self.changedBlocks.get(index)
+        if changed is None:
+            return
+        for tile in list(self.chunks[index].tiles):
+            changes = changed.get((tile.cellX, tile.cellY))
+            if changes is not None:
+                tile.restore(changes)
+                if isinstance(tile, BrickBlock) and tile.destroyed:
+                    self.removeTile(tile)
+
+    def readChunk (self, index):
+        # Ground and pipe cells are collected and merged once the chunk's
+        # other tiles are loaded.
+        first = index * chunkColumns
+        last = min(first + chunkColumns, self.columns)
+        cells = {}
+        if self.data is None:
+            for y in range(self.rows):
+                row = self.textRows[y]
+                for x in range(first, last):
+                    if row[x] in mergedTiles:
+                        cells[(x, y)] = row[x]
+                    elif row[x] not in spawnTiles:
+                        self.loadItem(row[x], x, y)
+            self.mergeTiles(cells)
+            return
+
+        for tile, x, y in self.blocks.get(index, ()):
+            self.loadItem(tile, x, y)
+        for x in range(first, last):
+            offset = levelOffset.unpack_from(self.data, levelHeader.size + x * levelOffset.size)[0]
+            y = 0
+            while y < self.rows:
+                tile, count = levelRun.unpack_from(self.data, offset)
+                offset += levelRun.size
+                if tile in mergedTiles:
+                    for row in range(y, y + count):
+                        cells[(x, row)] = tile
+                elif tile != blankTile:
+                    for row in range(y, y + count):
+                        self.loadItem(tile, x, row)
+                y += count
+        self.mergeTiles(cells)
+
+    def mergeTiles (self, cells):
+        # Greedily cover the cells with rectangles of one kind of tile:
+        # from the first free cell in reading order, as wide as the row
+        # allows, then as deep as the rows below match. cells only holds
+        # one chunk, so rectangles stop at its edges.
+        for x, y in sorted(cells, key=lambda cell: (cell[1], cell[0])):
+            tile = cells.get((x, y))
+            if tile is None:
+                continue
+            w = 1
+            while cells.get((x + w, y)) == tile:
+                w += 1
+            h = 1
+            while all(cells.get((x + i, y + h)) == tile for i in range(w)):
+                h += 1
+            for j in range(h):
+                for i in range(w):
+                    del cells[(x + i, y + j)]
+
+            if tile == groundTile:
+                self.addTile(GroundBlock(x * tileWidth, y * tileWidth, w * tileWidth, h * tileWidth, groundBrown))
+            elif tile == pipeTile:
+                self.addTile(Pipe(x * tileWidth, y * tileWidth, w * tileWidth, h * tileWidth, green))
+
+    def evictChunk (self, index):
+        # Take a chunk's tiles, fragments in flight included, out of
+        # everything but the map, which the caller prunes once. Only what
+        # changed in its blocks is kept for when a respawn brings the
+        # camera back.
+        chunk = self.chunks.pop(index)
+        for tile in chunk.tiles:
+            self.keepChanges(tile)
+            self.tileGrid.remove(tile)
+            tile.grid = None
+            self.forgetCells(tile)
+            if tile in self.animatedTiles:
+                self.animatedTiles.remove(tile)
+            if tile.awake:
+                self.awakeTiles.remove(tile)
+                tile.awake = False
+            # Contacts would keep despawned enemies and the tile alive
+            # in a cycle.
+            del tile.collidingObjects[:]
+            tile.hasCollision = False
+            tile.chunk = None
+        chunk.release()
+
+    def keepChanges (self, tile):
+        changes = tile.changes()
+        if changes is not None:
+            self.changedBlocks.setdefault(tile.chunk.index, {})[(tile.cellX, tile.cellY)] = changes
 
     def loadItem (self, tile, x, y):
         xPos = x * tileWidth
@@ -1225,83 +2275,323 @@ class Level:
             return
         
         elif (tile == groundTile):
-            self.map.append(GroundBlock(xPos, yPos, tileWidth, tileWidth, groundBrown))
+            self.addTile(GroundBlock(xPos, yPos, tileWidth, tileWidth, groundBrown))
 
         elif (tile == marioTile):
-            self.entities.append(Mario(xPos, yPos+10, tileWidth-10, tileWidth-10, white))
+            self.addEntity(Mario(xPos, yPos+10, tileWidth-10, tileWidth-10, white))
 
         elif (tile == blockTile):
-            self.map.append(BrickBlock(xPos, yPos, tileWidth, tileWidth, brickBrown))
+            self.addTile(BrickBlock(xPos, yPos, tileWidth, tileWidth, brickBrown))
 
         elif (tile == bCoinTile):
             coinBlock = BrickBlock(xPos, yPos, tileWidth, tileWidth, brickBrown)
             coinBlock.hasCoins = True
-            self.map.append(coinBlock)
+            self.addTile(coinBlock)
 
         elif (tile == qCoinTile):
-            self.map.append(QuestionBlock(xPos, yPos, tileWidth, tileWidth, "coin", gold))
+            self.addTile(QuestionBlock(xPos, yPos, tileWidth, tileWidth, "coin", gold))
 
         elif (tile == qMushTile):
-            self.map.append(QuestionBlock(xPos, yPos, tileWidth, tileWidth, "mushroom", gold))
+            self.addTile(QuestionBlock(xPos, yPos, tileWidth, tileWidth, "mushroom", gold))
 
         elif (tile == qOneUpTile):
-            self.map.append(OneUpBlock(xPos, yPos, tileWidth, tileWidth, "1up", grey))
+            self.addTile(OneUpBlock(xPos, yPos, tileWidth, tileWidth, "1up", grey))
 
         elif (tile == pipeTile):
-            self.map.append(Pipe(xPos, yPos, tileWidth, tileWidth, green))
+            self.addTile(Pipe(xPos, yPos, tileWidth, tileWidth, green))
+
+        elif (tile == goombaTile or tile == koopaTile):
+            # Enemies are only made once a player comes near, see
+            # spawnEnemies.
+            self.spawns.append((xPos - screenSize[0]/2, len(self.spawns), tile, xPos, yPos))
 
-        elif (tile == goombaTile):
-            self.entities.append(Goomba(xPos, yPos, tileWidth, tileWidth, xPos - screenSize[0]/2, goombaColor))
+    def makeEnemy (self, tile, xPos, yPos):
+        if (tile == goombaTile):
+            return Goomba(xPos, yPos, tileWidth, tileWidth, goombaColor)
 
         elif (tile == koopaTile):
-            self.entities.append(Koopa(xPos, yPos, tileWidth, tileWidth, xPos - screenSize[0]/2, koopaColor))
+            return Koopa(xPos, yPos, tileWidth, tileWidth, koopaColor)
+
+    def spawnEnemies (self):
+        # Make the enemies whose spawn x the leading player has passed.
+        # Until then they are only an entry in the sorted spawn list, so
+        # they start out moving.
+        players = self.getPlayers()
+        if not players:
+            return
+        lead = players[0].x
+        for mario in players:
+            if mario.x > lead:
+                lead = mario.x
+        while self.pendingSpawns and lead > self.pendingSpawns[-1][0]:
+            spawn = self.pendingSpawns.pop()
+            spawnX, order, tile, xPos, yPos = spawn
+            enemy = self.makeEnemy(tile, xPos, yPos)
+            enemy.spawn = spawn
+            self.addEntity(enemy)
+
+    def rewindSpawns (self):
+        # A player respawned at the start, so enemies that were despawned
+        # behind the camera can be met again.
+        self.pendingSpawns = sorted(self.pendingSpawns + self.passedSpawns, reverse=True)
+        self.passedSpawns = []
 
     def update (self, deltaTime):
-        for tile in self.map:
+        self.streamChunks(camera.x)
+
+        # Only tiles that were touched or are still animating are updated.
+        # The rest of the map sleeps.
+        tiles = self.awakeTiles
+        self.awakeTiles = self.updatingTiles
+        self.updatingTiles = tiles
+        for tile in tiles:
+            tile.awake = False
+        for tile in tiles:
             tile.update(deltaTime)
-            
+            if tile.chunk is not None and tile.isAnimating():
+                self.wakeTile(tile)
+        del tiles[:]
+
+        self.updateWindow()
+
+        # New enemies collide from this step and move from the next.
         for entity in self.entities:
-            entity.update(deltaTime)
+            if not entity.frozen:
+                entity.update(deltaTime)
+        self.spawnEnemies()
         
         self.checkCollisions()
 
+    def updateWindow (self):
+        # Entities outside the simulation window around the camera are
+        # frozen. The camera never scrolls left, so those behind it, or
+        # fallen below it, are despawned for good.
+        margin = options.simulation_margin
+        left = camera.x - margin
+        right = camera.x + camera.w + margin
+        bottom = camera.y + camera.h + margin
+        # Despawning removes from the entity list, so walk a copy, made
+        # in a list that is kept from step to step.
+        window = self.window
+        window[:] = self.entities
+        for entity in window:
+            if entity.x + entity.w < left or entity.y > bottom:
+                entity.despawn()
+            entity.frozen = entity.x + entity.w < left or entity.x > right or entity.isParked()
+        del window[:]
+
     def checkCollisions (self):
-        for entity in self.entities:
+        # Check Entity/Entity collisions by sweep and prune along x. With
+        # entities sorted by their left edge, each is only tested against
+        # the ones after it that start before its right edge, and each
+        # contact goes to both sides. Frozen entities don't take contacts.
+        # This is the one place per step the index is sorted.
+        self.entityIndex.refresh()
+        entities = self.entityIndex.objects
+        count = len(entities)
+        for i in xrange(count):
+            entity = entities[i]
+            right = entity.rect.right
+            for j in xrange(i + 1, count):
+                entity2 = entities[j]
+                if entity2.rect.left >= right:
+                    break
+                if entity.frozen and entity2.frozen:
+                    continue
+                if entity.rect.colliderect(entity2.rect):
+                    if not entity.frozen:
+                        entity.addCollision(entity2)
+                    if not entity2.frozen:
+                        entity2.addCollision(entity)
 
-            # Check Entity/Entity collisions.
-            for entity2 in self.entities:
-                if entity != entity2 and entity.rect.colliderect(entity2.rect):
-                    entity.addCollision(entity2)
+        for entity in self.entities:
+            if entity.frozen:
+                continue
                     
             # Check Entity/World collisions.
-            for tile in self.map:
+            for tile in self.tileGrid.query(entity.rect):
                 if tile.rect.colliderect(entity.rect):
                     entity.addCollision(tile)
                     tile.addCollision(entity)
 
     def removeEntity (self, entity):
+        # An entity can be removed again through a contact made before it
+        # left, e.g. a goomba that despawned while its squish ran.
+        if entity.removed:
+            return
+        entity.removed = True
         self.entities.remove(entity)
+        role = entity.role()
+        if role == "player":
+            self.players.remove(entity)
+        pool = self.pools.get(role)
+        if pool is not None and entity in pool.free:
+            pool.free.remove(entity)
+        else:
+            self.entityIndex.remove(entity)
+
+    def takeItem (self, role, x, y):
+        # A free pooled item moved to (x, y), or None if all of them are
+        # out. Parked items are neither drawn nor collide, so they are
+        # only in the entity index while taken.
+        item = self.pools[role].acquire()
+        if item is not None:
+            item.setX(x)
+            item.setY(y)
+            self.entityIndex.add(item)
+        return item
+
+    def parkItem (self, entity):
+        pool = self.pools[entity.role()]
+        if entity not in pool.free:
+            pool.release(entity)
+            self.entityIndex.remove(entity)
+
+    def wakeTile (self, tile):
+        if not tile.awake:
+            tile.awake = True
+            self.awakeTiles.append(tile)
 
     def removeTile (self, tile):
+        self.keepChanges(tile)
         self.map.remove(tile)
+        self.releaseTile(tile)
+
+    def releaseTile (self, tile):
+        # Take tile out of everything but the map.
+        self.tileGrid.remove(tile)
+        tile.grid = None
+        self.forgetCells(tile)
+        tile.chunk.tiles.remove(tile)
+        tile.chunk.invalidate()
+        tile.chunk = None
+        self.markChanged(tile)
+        if tile in self.animatedTiles:
+            self.animatedTiles.remove(tile)
+        if tile.awake:
+            self.awakeTiles.remove(tile)
+            tile.awake = False
+
+    def savePositions (self):
+        for entity in self.entities:
+            entity.savePosition()
 
     def addEntity (self, entity):
+        # Pooled items must be added parked, they start out free.
+        entity.removed = False
         self.entities.append(entity)
+        role = entity.role()
+        if role == "player":
+            self.players.append(entity)
+        pool = self.pools.get(role)
+        if pool is not None:
+            pool.release(entity)
+        else:
+            self.entityIndex.add(entity)
+
+    def addTile (self, tile):
+        # Tiles are indexed by the grid cells they were loaded into, so a
+        # block that is bumped up keeps its cell.
+        tile.cellX = int(tile.x // tileWidth)
+        tile.cellY = int(tile.y // tileWidth)
+        self.placeTile(tile)
+
+    def placeTile (self, tile):
+        self.map.append(tile)
+        self.tileGrid.insert(tile)
+        tile.grid = self.tileGrid
+        for key in self.tileCells(tile):
+            self.tiles[key] = tile
+
+        index = tile.cellX // chunkColumns
+        tile.chunk = self.chunks.get(index)
+        if tile.chunk is None:
+            tile.chunk = LevelChunk(index)
+            self.chunks[index] = tile.chunk
+        tile.chunk.tiles.append(tile)
+        tile.chunk.invalidate()
+
+    def markChanged (self, tile):
+        # Only the dirty rect renderer reads these, and it empties the
+        # list every frame, so nothing is kept without it.
+        if options.dirty_rects:
+            self.changedRects.append(Rect(tile.rect))
+
+    def tileChanged (self, tile):
+        # Animating tiles are drawn on their own every frame and left out
+        # of their chunk until they come to rest again.
+        tile.chunk.invalidate()
+        self.markChanged(tile)
+        if tile.isAnimating():
+            self.wakeTile(tile)
+            if tile not in self.animatedTiles:
+                self.animatedTiles.append(tile)
+        elif tile in self.animatedTiles:
+            self.animatedTiles.remove(tile)
+
+    def tileCells (self, tile):
+        # Merged tiles cover more than one cell.
+        return [(col, row) for row in range(tile.cellY, tile.cellY + int(tile.h // tileWidth)) for col in range(tile.cellX, tile.cellX + int(tile.w // tileWidth))]
+
+    def forgetCells (self, tile):
+        for key in self.tileCells(tile):
+            if self.tiles.get(key) is tile:
+                del self.tiles[key]
+
+    def tilesBelow (self, rect):
+        # Tiles that could touch the one pixel row under rect. The row
+        # beneath is included for blocks bumped up into that row.
+        # The list returned is refilled by the next call.
+        row = rect.bottom // tileWidth
+        tiles = self.below
+        del tiles[:]
+        for col in xrange((rect.left + 1) // tileWidth, (rect.right - 2) // tileWidth + 1):
+            for cellY in (row, row + 1):
+                tile = self.tiles.get((col, cellY))
+                if tile is not None and tile not in tiles:
+                    tiles.append(tile)
+        return tiles
                 
-    def getMario (self):
-        for entity in self.entities:
-            if isinstance(entity, Mario):
-                return entity
-        return None
-
-    def draw (self):
-        for tile in self.map:
-            tile.draw()
+    def getPlayers (self):
+        return self.players
 
+    def getMario (self):
+        # The first player, if there is one.
+        if not self.players:
+            return None
+        return self.players[0]
+
+    def draw (self, area=None):
+        # Draw the whole view, or only the part of the screen in area.
+        left = camera.drawX
+        right = camera.drawX + camera.w
+        if area is not None:
+            left += area.left
+            right = camera.drawX + area.right
+
+        # Blit the chunks covering the view. The camera never scrolls
+        # left, so chunks behind it can drop their surfaces.
+        chunkWidth = chunkColumns * tileWidth
+        first = int(left // chunkWidth)
+        last = int(right // chunkWidth)
+        if area is None:
+            for index in range(self.firstDrawnChunk, first):
+                if index in self.chunks:
+                    self.chunks[index].release()
+            self.firstDrawnChunk = first
+        for index in range(first, last + 1):
+            if index in self.chunks:
+                self.chunks[index].draw()
+
+        for tile in self.animatedTiles:
             if isinstance(tile, BrickBlock) and tile.destroyed:
                 tile.currState.draw()
+            elif camera.canSee(tile.x, tile.w):
+                tile.draw()
             
-        for entity in self.entities:
+        # The index was last sorted by checkCollisions, after everything
+        # moved this step.
+        for entity in self.entityIndex.query(left - drawMargin, right + drawMargin):
             entity.draw()
 
 # 1-1
@@ -1318,13 +2608,29 @@ class LevelOneOne (Level):
 # Globals
 ####################################
 
+# Options
+parser = argparse.ArgumentParser(description="Super Mario Bros 1-1")
+parser.add_argument("--level", default="1-1.txt", metavar="FILE", help="level to play, either a text map or a compiled level")
+parser.add_argument("--compile", nargs=2, metavar=("SOURCE", "TARGET"), help="compile the text map SOURCE into the binary level TARGET and exit")
+parser.add_argument("--headless", action="store_true", help="simulate without a window and without rendering")
+parser.add_argument("--frames", type=int, default=3600, help="number of frames to simulate in headless mode")
+parser.add_argument("--fixed-step", type=float, nargs="?", const=fixedStepRate, metavar="HZ", help="step the physics at a fixed rate (default %d Hz) and interpolate rendering" % fixedStepRate)
+parser.add_argument("--dirty-rects", action="store_true", help="only redraw the parts of the screen that changed")
+parser.add_argument("--record", metavar="FILE", help="record the input of this run to FILE")
+parser.add_argument("--replay", metavar="FILE", help="replay the input recorded in FILE")
+parser.add_argument("--simulation-margin", type=int, default=simulationMargin, metavar="PIXELS", help="simulate entities this far outside the view; further ahead they freeze, further behind they despawn (default %d)" % simulationMargin)
+options, unknownOptions = parser.parse_known_args()
+
 # Display
+if options.headless:
+    # No window; the dummy driver still gives us keyboard state and a screen surface.
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
 pygame.init()
 screenSize = [1280,720]
 screenBGColor = lightBlue
 
 # Levels
-levelHandle = "1-1.txt"
+levelHandle = options.level
 level = LevelOneOne(levelHandle)
 
 # Font
@@ -1338,50 +2644,165 @@ hud = HUD()
 clock = pygame.time.Clock()
 running = True
 
+# Input
+if options.replay:
+    inputSource = ReplayInput(options.replay)
+else:
+    inputSource = KeyboardInput()
+
+# Simulation
+collisionResponses = buildCollisionResponses()
+stepRate = options.fixed_step
+if options.replay:
+    stepRate = inputSource.rate
+elif options.record and not stepRate:
+    # Recordings hold one input per step, so they need a fixed step.
+    stepRate = fixedStepRate
+fixedStep = None
+stepScale = 1.0 # per-step physics changes are tuned for fixedStepRate steps a second
+if stepRate:
+    fixedStep = 1000.0 / stepRate
+    stepScale = fixedStep / (1000.0 / fixedStepRate)
+accumulator = 0.0
+renderAlpha = 1.0
+
+if options.record:
+    inputSource = InputRecorder(inputSource, options.record, stepRate)
+controls = Controls(inputSource)
+
+# Rendering
+dirtyRects = None
+if options.dirty_rects:
+    dirtyRects = DirtyRects()
+
 
 ####################################
 # Functions
 ####################################
 
+def compileLevel (source, target):
+    with open(source) as f:
+        tileRows = [row.rstrip("\n") for row in f.readlines()]
+    columns = max(len(row) for row in tileRows)
+    tileRows = [row.ljust(columns) for row in tileRows]
+
+    spawns = []
+    blocks = []
+    for y in range(len(tileRows)):
+        for x in range(columns):
+            tile = tileRows[y][x]
+            if tile in spawnTiles:
+                spawns.append(levelItem.pack(x, y, tile))
+            elif tile in contentTiles:
+                blocks.append(levelItem.pack(x, y, tile))
+
+    # Run-length encode each column from the top; the mostly blank
+    # padding collapses to a run or two per column.
+    runs = []
+    offsets = []
+    offset = levelHeader.size + columns * levelOffset.size + (len(spawns) + len(blocks)) * levelItem.size
+    for x in range(columns):
+        offsets.append(levelOffset.pack(offset))
+        column = [row[x] if row[x] in runTiles else blankTile for row in tileRows]
+        y = 0
+        while y < len(column):
+            count = 1
+            while y + count < len(column) and count < 255 and column[y + count] == column[y]:
+                count += 1
+            runs.append(levelRun.pack(column[y], count))
+            offset += levelRun.size
+            y += count
+
+    with open(target, "wb") as f:
+        f.write(levelHeader.pack(levelMagic, 1, columns, len(tileRows), len(spawns), len(blocks)))
+        f.write(b"".join(offsets))
+        f.write(b"".join(spawns))
+        f.write(b"".join(blocks))
+        f.write(b"".join(runs))
+
 def resetCollisions (entity):
-    entity.collidingObjects = []
+    # addCollision empties the list before it is used again.
     entity.hasCollision = False
 
 def collision_sides (a, b):
-    sides = Struct(left=False, right=False, top=False, bottom=False)
-    
-    left = Rect(a.left, a.top + 1, 1, a.height - 2)
-    right = Rect(a.right, a.top + 1, 1, a.height - 2)
-    top = Rect(a.left + 1, a.top, a.w - 2, 1)
-    bottom = Rect(a.left + 1, a.bottom, a.width - 2, 1)
-
-    if left.colliderect(b):
-        sides.left = True
-    if right.colliderect(b):
-        sides.right = True
-    if top.colliderect(b):
-        sides.top = True
-    if bottom.colliderect(b):
-        sides.bottom = True
-
-    return sides
-
-def checkMushroomMarioCollision (entity, tile):
-    if isinstance(tile, Mario):
-        if entity.mType == "super":
-            tile.setSuper(True)
-            
-        elif entity.mType == "1up":
-            tile.addLife()
+    return sidesByMask[collision_mask(a, b)]
+
+def collision_mask (a, b):
+    # Which one pixel strips just inside the edges of a overlap b, worked
+    # out on the rects' intervals. The left and right strips leave out
+    # the corners, as do the top and bottom ones.
+    ax = a.x
+    ay = a.y
+    aw = a.w
+    ah = a.h
+    bx = b.x
+    by = b.y
+    bRight = bx + b.w
+    bBottom = by + b.h
+    mask = 0
+    if ah > 2 and ay + 1 < bBottom and ay + ah - 1 > by:
+        if bx <= ax < bRight:
+            mask = sideLeft
+        if bx <= ax + aw < bRight:
+            mask |= sideRight
+    if aw > 2 and ax + 1 < bRight and ax + aw - 1 > bx:
+        if by <= ay < bBottom:
+            mask |= sideTop
+        if by <= ay + ah < bBottom:
+            mask |= sideBottom
+    return mask
+
+def collision_contact (a, b):
+    # The collision_mask of two entities' rects, and how far a overlaps b
+    # through the side of the contact: the left or right one if a touches
+    # b there, else the top or bottom one. Left and top win, as they do in
+    # the response rules. The depth is worked out on the entities' own
+    # positions, which the rects round.
+    mask = collision_mask(a.rect, b.rect)
+    if mask & sideLeft:
+        return mask, b.x + b.w - a.x
+    if mask & sideRight:
+        return mask, a.x + a.w - b.x
+    if mask & sideTop:
+        return mask, b.y + b.h - a.y
+    if mask & sideBottom:
+        return mask, a.y + a.h - b.y
+    return mask, 0
+
+def releaseMushroom (entity):
+    # Park the mushroom off screen and hand it back to its pool.
+    entity.setX(-100)
+    entity.setY(100)
+    entity.changeState("spawn")
+    entity.active = False
+    level.parkItem(entity)
+
+def spawnItem (role, x, y, stateID):
+    # Start a free item of role at (x, y), or return None if all of them
+    # are out.
+    item = level.takeItem(role, x, y)
+    if item is not None:
+        item.changeState(stateID)
+    return item
+
+def spawnCoin (x, y):
+    # A coin counts even when every coin is still in the air.
+    if spawnItem("coin", x, y, "idle") is None:
+        hud.coins += 1
 
-        # Reset Mushroom entity
-        entity.setX(-100)
-        entity.setY(100)
-        entity.changeState("spawn")
-        entity.active = False
+def sweepInterval (position, size, move, tilePosition, tileSize):
+    # The fractions of a move along one axis at which a box starts and
+    # stops overlapping a tile on that axis.
+    if move > 0:
+        return (tilePosition - (position + size)) / float(move), (tilePosition + tileSize - position) / float(move)
+    if move < 0:
+        return (tilePosition + tileSize - position) / float(move), (tilePosition - (position + size)) / float(move)
+    if position < tilePosition + tileSize and position + size > tilePosition:
+        return float("-inf"), float("inf")
+    return float("inf"), float("-inf")
 
 def should_fall (entity):
-    for tile in level.map:
+    for tile in level.tilesBelow(entity.rect):
         sides = collision_sides(entity.rect, tile.rect)
         if sides.bottom:
             return False
@@ -1392,71 +2813,143 @@ def updateFall (entity, deltaTime):
     
     # Check for landing
     if entity.hasCollision:
-        for tile in entity.collidingObjects:
-            sides = collision_sides(entity.rect, tile.rect)
-            if sides.bottom:
-                # If entity fell on Mario then it's an enemy
-                # and this should trigger death or power-down in Mario.
-                if isinstance(tile, Mario):
-                    return
-                
-                entity.setY(tile.top() - entity.h)
-                entity.changeState("idle")
-                entity.hasCollision = False
-                entity.collidingObjects = []
-                return True 
+        stopped = respond(entity, "landing")
+        if stopped is not None:
+            return stopped
     
     if entity.dy > maxVelocity:
         entity.dy = maxVelocity
     else:
-        entity.dy += entity.velocity
+        entity.dy += entity.velocity * stepScale
         
-    entity.velocity += gravity
+    entity.velocity += gravity * stepScale
     entity.translate(0, entity.dy * deltaTime)
 
     return landed
 
+def checkMario ():
+    global running, camera
+    mario = level.getMario()
+    if not mario is None and (mario.y > screenSize[1] or mario.isDead):
+        mario.removeLife()
+        
+        if mario.lives < 0:
+            print "Game Over"
+            running = False
+
+        else:
+            mario.isDead = False
+            mario.reset()
+            level.entityIndex.refresh()
+            camera = Camera()
+            level.rewindSpawns()
+
 def render ():
+    camera.setDrawValues(renderAlpha)
+    if dirtyRects is not None:
+        dirtyRects.render()
+        return
+
+    del level.changedRects[:]
     screen.fill(screenBGColor)
     level.draw()
     hud.draw()
     pygame.display.flip()
 
-def tick ():
-    deltaTime = clock.tick(60)
+def inputMask (keys):
+    mask = 0
+    for key in keys:
+        mask |= controlBits[key]
+    return mask
+
+def step (deltaTime):
+    controls.poll()
     level.update(deltaTime)
     camera.update()
     hud.update(deltaTime)
+    checkMario()
+
+def tick (deltaTime=None):
+    global accumulator, renderAlpha
+    if deltaTime is None:
+        # Fixed steps are drawn between at renderAlpha, so frames are
+        # only capped when each one is a step.
+        if fixedStep is None:
+            deltaTime = clock.tick(60)
+        else:
+            deltaTime = clock.tick()
+
+    if fixedStep is None:
+        step(deltaTime)
+        return
+
+    # Consume the frame time in constant steps so runs don't depend on
+    # machine load. After maxCatchUpSteps the backlog is dropped. A replay
+    # takes no steps past its end.
+    accumulator += deltaTime
+    steps = 0
+    while accumulator >= fixedStep and steps < maxCatchUpSteps and running and not controls.finished():
+        level.savePositions()
+        camera.savePosition()
+        step(fixedStep)
+        accumulator -= fixedStep
+        steps += 1
+    if accumulator >= fixedStep:
+        accumulator = 0.0
+    renderAlpha = accumulator / fixedStep
     
 
 ####################################
 # Main loop
 ####################################
 
-while running:
+def handleEvents ():
+    global running
     for event in pygame.event.get():
         if event.type == QUIT:
             running = False
         if event.type == KEYDOWN and event.key == K_ESCAPE:
             running = False
 
-    tick()
-    render()
-
-    mario = level.getMario()
-    if not mario is None and (mario.y > screenSize[1] or mario.isDead):
-        mario.removeLife()
-        
-        if mario.lives < 0:
-            print "Game Over"
-            running = False
-
+def run ():
+    # Like runHeadless, stop once a replay has run out of input.
+    while running and not controls.finished():
+        handleEvents()
+        tick()
+        render()
+    if controls.finished():
+        print "Replay finished"
+
+def runHeadless (frames):
+    # Step the simulation as fast as the CPU allows, feeding each frame
+    # the delta a 60 fps clock would have produced.
+    deltaTime = 1000 / 60
+    if fixedStep is not None:
+        deltaTime = fixedStep
+    frame = 0
+    start = time.time()
+    while running and frame < frames and not controls.finished():
+        tick(deltaTime)
+        frame += 1
+    elapsed = time.time() - start
+
+    if elapsed > 0:
+        print "Simulated %d frames in %.3f s (%.1f frames/s)" % (frame, elapsed, frame / elapsed)
+
+if __name__ == "__main__":
+    # Close the input even after a crash or Ctrl-C, so a recording of
+    # what led up to it is still written.
+    try:
+        if options.compile:
+            compileLevel(options.compile[0], options.compile[1])
+            print "Compiled %s to %s" % (options.compile[0], options.compile[1])
+        elif options.headless:
+            runHeadless(options.frames)
         else:
-            mario.isDead = False
-            mario.reset()
-            camera = Camera()
-
-pygame.quit()
+            run()
+    finally:
+        controls.close()
+        pygame.quit()
 
 
 
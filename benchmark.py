@@ -0,0 +1,318 @@
+import os
+import sys
+import json
+import time
+import argparse
+import random
+import shutil
+import tempfile
+
+####################################
+# Options
+####################################
+
+parser = argparse.ArgumentParser(description="Benchmark the SMB update, collision, render and HUD phases")
+parser.add_argument("--frames", type=int, default=1500, help="frames to simulate per level")
+parser.add_argument("--widen", type=int, default=4, help="how many times 1-1 is repeated for the wide level")
+parser.add_argument("--densify", type=int, default=4, help="enemy density multiplier for the dense level")
+parser.add_argument("--output", metavar="FILE", help="write the JSON results to FILE instead of stdout")
+parser.add_argument("--baseline", metavar="FILE", help="compare against the JSON results of an earlier run")
+parser.add_argument("--tolerance", type=float, default=0.10, help="fraction a mean may slow down before it counts as a regression")
+parser.add_argument("--max-rects", type=float, default=0.1, help="Rects the update loop may build per frame before it counts as a regression")
+options = parser.parse_args()
+
+# pygame and SMB print to stdout, which is reserved for the results.
+resultsFile = sys.stdout
+sys.stdout = sys.stderr
+
+# SMB parses the command line when imported, so only hand it ours.
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+sys.argv = [sys.argv[0], "--headless"]
+import SMB
+from pygame.locals import *
+
+frameTime = 1000 / 60.0
+
+####################################
+# Levels
+####################################
+
+def readRows (fileName):
+    with open(fileName) as f:
+        rows = [row.rstrip("\n") for row in f]
+    width = max(len(row) for row in rows)
+    return [row.ljust(width) for row in rows]
+
+def writeLevel (directory, name, rows):
+    fileName = os.path.join(directory, name + ".txt")
+    with open(fileName, "w") as f:
+        f.write("\n".join(rows) + "\n")
+    return fileName
+
+def widen (rows, times):
+    # Repeat the level to the right, keeping only the first Mario.
+    copies = [row.replace(SMB.marioTile, SMB.blankTile) for row in rows]
+    return [row + copy * (times - 1) for row, copy in zip(rows, copies)]
+
+def densify (rows, times):
+    # Stand extra goombas on the ground, more of them for higher times.
+    rows = [list(row) for row in rows]
+    spacing = max(2, 16 // times)
+    for y in range(len(rows) - 1):
+        for x in range(20, len(rows[y]), spacing):
+            if rows[y][x] == SMB.blankTile and rows[y + 1][x] == SMB.groundTile:
+                rows[y][x] = SMB.goombaTile
+    return ["".join(row) for row in rows]
+
+def makeLevels (directory):
+    rows = readRows(SMB.levelHandle)
+    return [
+        ("1-1", SMB.levelHandle),
+        ("1-1-wide-x%d" % options.widen, writeLevel(directory, "wide", widen(rows, options.widen))),
+        ("1-1-dense-x%d" % options.densify, writeLevel(directory, "dense", densify(rows, options.densify))),
+    ]
+
+####################################
+# Timing
+####################################
+
+class Phase (object):
+    def __init__ (self, name):
+        self.name = name
+        self.samples = []
+
+    def wrap (self, function):
+        def timed (*args):
+            start = time.time()
+            result = function(*args)
+            self.samples.append(time.time() - start)
+            return result
+        return timed
+
+    def summary (self):
+        samples = sorted(self.samples)
+        if not samples:
+            return None
+        return {
+            "calls": len(samples),
+            "mean_ms": 1000 * sum(samples) / len(samples),
+            "p50_ms": 1000 * percentile(samples, 0.50),
+            "p99_ms": 1000 * percentile(samples, 0.99),
+        }
+
+def percentile (samples, fraction):
+    return samples[int(round(fraction * (len(samples) - 1)))]
+
+####################################
+# Runs
+####################################
+
+def script (frames):
+    # Run right, jumping every 50 frames and sprinting every other
+    # 200 frames.
+    for frame in range(frames):
+        keys = [K_d]
+        if frame % 50 < 3:
+            keys.append(K_SPACE)
+        if (frame // 200) % 2 == 1:
+            keys.append(K_LSHIFT)
+        yield SMB.inputMask(keys)
+
+def start (fileName):
+    SMB.level = SMB.LevelOneOne(fileName)
+    SMB.camera = SMB.Camera()
+    SMB.hud = SMB.HUD()
+    SMB.controls = SMB.Controls(SMB.ScriptedInput(script(options.frames)))
+    SMB.running = True
+
+def keepPlaying ():
+    # Keep playing after a game over so every run has the same length.
+    if not SMB.running:
+        SMB.running = True
+        SMB.level.getMario().lives = 3
+
+def benchmark (name, fileName):
+    start(fileName)
+
+    phases = {}
+    for phaseName, obj, method in [("update", SMB.level, "update"), ("collisions", SMB.level, "checkCollisions"), ("level_draw", SMB.level, "draw"), ("hud_draw", SMB.hud, "draw")]:
+        phases[phaseName] = Phase(phaseName)
+        setattr(obj, method, phases[phaseName].wrap(getattr(obj, method)))
+    phases["tick"] = Phase("tick")
+    phases["render"] = Phase("render")
+    tick = phases["tick"].wrap(SMB.tick)
+    render = phases["render"].wrap(SMB.render)
+
+    entities = len(SMB.level.entities)
+    spawns = len(SMB.level.spawns)
+    tiles = len(SMB.level.map)
+    for frame in range(options.frames):
+        tick(frameTime)
+        render()
+        keepPlaying()
+
+    tickTime = sum(phases["tick"].samples)
+    frameTotal = tickTime + sum(phases["render"].samples)
+    result = {
+        "level": name,
+        "frames": options.frames,
+        "tiles": tiles,
+        "entities": entities,
+        "spawns": spawns,
+        "phases": dict((phaseName, phase.summary()) for phaseName, phase in phases.items()),
+        "simulated_fps": options.frames / tickTime if tickTime else None,
+        "frame_fps": options.frames / frameTotal if frameTotal else None,
+    }
+    return result
+
+class CountedRect (SMB.pygame.Rect):
+    built = 0
+
+    def __init__ (self, *args):
+        CountedRect.built += 1
+        SMB.pygame.Rect.__init__(self, *args)
+
+def allocations (name, fileName):
+    # Count the Rects built while simulating. Entities move, collide and
+    # forget collisions in place, so only events such as a block breaking
+    # should build any. The tiles of chunks streamed in are counted apart.
+    start(fileName)
+    streamed = [0]
+    loadChunk = SMB.level.loadChunk
+    def countedLoad (index):
+        before = CountedRect.built
+        loadChunk(index)
+        streamed[0] += CountedRect.built - before
+    SMB.level.loadChunk = countedLoad
+
+    CountedRect.built = 0
+    SMB.Rect = CountedRect
+    try:
+        for frame in range(options.frames):
+            SMB.tick(frameTime)
+            keepPlaying()
+    finally:
+        SMB.Rect = SMB.pygame.Rect
+    return {"level": name, "rects_per_frame": (CountedRect.built - streamed[0]) / float(options.frames), "streamed_rects_per_frame": streamed[0] / float(options.frames)}
+
+def loadTimes (name, fileName, directory):
+    # Compare parsing the text map with loading its compiled form, and
+    # both with resetting a loaded level.
+    compiled = os.path.join(directory, os.path.basename(fileName) + ".lvl")
+    SMB.compileLevel(fileName, compiled)
+    result = {"level": name}
+    for key, path in [("text", fileName), ("compiled", compiled)]:
+        load = Phase(key)
+        for i in range(10):
+            level = load.wrap(SMB.LevelOneOne)(path)
+        result[key] = load.summary()
+    reset = Phase("reset")
+    for i in range(10):
+        reset.wrap(level.reset)()
+    result["reset"] = reset.summary()
+    return result
+
+def probeSides (a, b):
+    # The original collision_sides: four one pixel probe Rects.
+    left = SMB.Rect(a.left, a.top + 1, 1, a.height - 2)
+    right = SMB.Rect(a.right, a.top + 1, 1, a.height - 2)
+    top = SMB.Rect(a.left + 1, a.top, a.w - 2, 1)
+    bottom = SMB.Rect(a.left + 1, a.bottom, a.width - 2, 1)
+    return SMB.Sides(left.colliderect(b), right.colliderect(b), top.colliderect(b), bottom.colliderect(b))
+
+def collisionKernel (pairs=20000, repeat=5):
+    # Time collision_sides against the probe version on entity sized
+    # rects around a tile, checking they agree on every pair.
+    generator = random.Random(1)
+    tile = SMB.Rect(500, 500, SMB.tileWidth, SMB.tileWidth)
+    rects = []
+    for i in range(pairs):
+        w = generator.choice([10, 20, 40, 50])
+        h = generator.choice([20, 30, 40, 50, 80])
+        rects.append(SMB.Rect(generator.randint(500 - w - 2, 552), generator.randint(500 - h - 2, 552), w, h))
+    mismatches = sum(1 for rect in rects if SMB.collision_sides(rect, tile) != probeSides(rect, tile))
+
+    result = {"pairs": pairs, "mismatches": mismatches}
+    for key, function in [("probe_ns", probeSides), ("kernel_ns", SMB.collision_sides), ("mask_ns", SMB.collision_mask)]:
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            for rect in rects:
+                function(rect, tile)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        result[key] = 1e9 * best / pairs
+    result["speedup"] = result["probe_ns"] / result["kernel_ns"]
+    return result
+
+def report (results):
+    for result in results:
+        sys.stderr.write("%s (%d tiles, %d entities, %d spawns): %.0f simulated frames/s, %.0f rendered frames/s\n" % (result["level"], result["tiles"], result["entities"], result["spawns"], result["simulated_fps"], result["frame_fps"]))
+        for phaseName in ["tick", "update", "collisions", "render", "level_draw", "hud_draw"]:
+            phase = result["phases"][phaseName]
+            sys.stderr.write("  %-10s mean %7.3f ms  p50 %7.3f ms  p99 %7.3f ms\n" % (phaseName, phase["mean_ms"], phase["p50_ms"], phase["p99_ms"]))
+
+def compare (results, baseline):
+    # Report phases whose mean got slower than the tolerance allows.
+    regressions = 0
+    old = dict((result["level"], result) for result in baseline["results"])
+    for result in results:
+        if result["level"] not in old:
+            continue
+        for phaseName, phase in sorted(result["phases"].items()):
+            oldPhase = old[result["level"]]["phases"].get(phaseName)
+            if not oldPhase or not oldPhase["mean_ms"]:
+                continue
+            change = phase["mean_ms"] / oldPhase["mean_ms"] - 1
+            if change > options.tolerance:
+                regressions += 1
+                sys.stderr.write("REGRESSION %s %s: %.3f ms -> %.3f ms (%+.0f%%)\n" % (result["level"], phaseName, oldPhase["mean_ms"], phase["mean_ms"], 100 * change))
+    return regressions
+
+def main ():
+    directory = tempfile.mkdtemp()
+    results = []
+    loads = []
+    allocated = []
+    try:
+        for name, fileName in makeLevels(directory):
+            results.append(benchmark(name, fileName))
+            loads.append(loadTimes(name, fileName, directory))
+            allocated.append(allocations(name, fileName))
+    finally:
+        shutil.rmtree(directory)
+    report(results)
+    for load in loads:
+        sys.stderr.write("%s load: text %.3f ms, compiled %.3f ms, reset %.3f ms\n" % (load["level"], load["text"]["mean_ms"], load["compiled"]["mean_ms"], load["reset"]["mean_ms"]))
+    failed = False
+    for result in allocated:
+        sys.stderr.write("%s: %.3f Rects built per frame, %.3f more for streamed tiles\n" % (result["level"], result["rects_per_frame"], result["streamed_rects_per_frame"]))
+        if result["rects_per_frame"] > options.max_rects:
+            sys.stderr.write("REGRESSION %s builds more than %.3f Rects per frame\n" % (result["level"], options.max_rects))
+            failed = True
+
+    kernel = collisionKernel()
+    sys.stderr.write("collision_sides: %.0f ns (probe Rects %.0f ns, bitmask only %.0f ns), %.1fx faster, %d mismatches\n" % (kernel["kernel_ns"], kernel["probe_ns"], kernel["mask_ns"], kernel["speedup"], kernel["mismatches"]))
+    if kernel["mismatches"]:
+        sys.stderr.write("REGRESSION collision_sides disagrees with the probe Rects on %d pairs\n" % kernel["mismatches"])
+        failed = True
+
+    output = {"python": sys.version.split()[0], "pygame": SMB.pygame.version.ver, "results": results, "loads": loads, "allocations": allocated, "collision_sides": kernel}
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        json.dump(output, resultsFile, indent=2, sort_keys=True)
+        resultsFile.write("\n")
+    SMB.pygame.quit()
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline):
+            failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
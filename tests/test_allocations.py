@@ -0,0 +1,131 @@
+import os
+import sys
+import gc
+import unittest
+
+# SMB parses the command line and loads 1-1 when imported, so it is
+# imported from the repository with only --headless, as benchmark.py does.
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(root)
+sys.path.insert(0, root)
+sys.argv = [sys.argv[0], "--headless"]
+import SMB
+from pygame.locals import *
+
+frameTime = 1000 / 60.0
+warmUpFrames = 300
+frames = 600
+
+####################################
+# Runs
+####################################
+
+def script ():
+    # Run right, jumping every 50 frames and sprinting every other
+    # 200 frames, for as long as the test asks.
+    frame = 0
+    while True:
+        keys = [K_d]
+        if frame % 50 < 3:
+            keys.append(K_SPACE)
+        if (frame // 200) % 2 == 1:
+            keys.append(K_LSHIFT)
+        yield SMB.inputMask(keys)
+        frame += 1
+
+def start ():
+    SMB.level = SMB.LevelOneOne(SMB.levelHandle)
+    SMB.camera = SMB.Camera()
+    SMB.hud = SMB.HUD()
+    SMB.controls = SMB.Controls(SMB.ScriptedInput(script()))
+    SMB.running = True
+
+def step ():
+    SMB.tick(frameTime)
+    # Keep playing after a game over so every run has the same length.
+    if not SMB.running:
+        SMB.running = True
+        SMB.level.getMario().lives = 3
+
+class CountedRect (SMB.pygame.Rect):
+    built = 0
+
+    def __init__ (self, *args):
+        CountedRect.built += 1
+        SMB.pygame.Rect.__init__(self, *args)
+
+def tracked ():
+    # The list get_objects returns is not counted in itself.
+    return len(gc.get_objects())
+
+####################################
+# Tests
+####################################
+
+# AllocationTest
+# Runs the update loop and bounds what it allocates per frame. The level
+# grows as chunks are first read and enemies spawn, so what those build
+# is counted apart. CPython 2 can't count objects that die within the
+# frame, so the update loop builds no such lists in the first place;
+# these tests catch Rects and anything it keeps.
+class AllocationTest (unittest.TestCase):
+    maxRects = 0.1 # per frame, events such as a brick breaking build some
+    maxKept = 0.02 # tracked objects per frame
+
+    def setUp (self):
+        start()
+        for frame in range(warmUpFrames):
+            step()
+
+        self.grown = [0, 0] # Rects, tracked objects
+        for name in ["loadChunk", "spawnEnemies"]:
+            self.countApart(name)
+
+    def tearDown (self):
+        SMB.Rect = SMB.pygame.Rect
+        gc.enable()
+
+    def countApart (self, name):
+        method = getattr(SMB.level, name)
+        def counted (*args):
+            rects = CountedRect.built
+            objects = tracked()
+            result = method(*args)
+            self.grown[0] += CountedRect.built - rects
+            self.grown[1] += tracked() - objects
+            return result
+        setattr(SMB.level, name, counted)
+
+    def testRectsPerFrame (self):
+        CountedRect.built = 0
+        SMB.Rect = CountedRect
+        for frame in range(frames):
+            step()
+        built = (CountedRect.built - self.grown[0]) / float(frames)
+        self.assertLessEqual(built, self.maxRects)
+
+    def testObjectsKeptPerFrame (self):
+        # With the collector off, an object only goes away when nothing
+        # refers to it, so every frame that ends with more tracked objects
+        # than it started with kept the difference.
+        gc.collect()
+        gc.disable()
+        kept = 0
+        for frame in range(frames):
+            grown = self.grown[1]
+            before = tracked()
+            step()
+            kept += max(0, tracked() - before - (self.grown[1] - grown))
+        self.assertLessEqual(kept / float(frames), self.maxKept)
+
+    def testNoGarbageCycles (self):
+        # Nothing the loop drops should need the cycle collector.
+        gc.collect()
+        gc.disable()
+        for frame in range(frames):
+            step()
+        self.assertEqual(gc.collect(), 0)
+
+if __name__ == "__main__":
+    unittest.main()
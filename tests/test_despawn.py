@@ -0,0 +1,75 @@
+import os
+import sys
+import unittest
+
+# SMB parses the command line and loads 1-1 when imported, so it is
+# imported from the repository with only --headless, as benchmark.py does.
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(root)
+sys.path.insert(0, root)
+sys.argv = [sys.argv[0], "--headless"]
+import SMB
+
+frameTime = 1000 / 60.0
+groundY = 650
+
+####################################
+# Runs
+####################################
+
+def start ():
+    SMB.level = SMB.LevelOneOne(SMB.levelHandle)
+    SMB.camera = SMB.Camera()
+    SMB.hud = SMB.HUD()
+    SMB.controls = SMB.Controls(SMB.ScriptedInput(iter([])))
+    SMB.running = True
+
+def update (cameraX):
+    # Steps the level alone so the camera stays where the test puts it.
+    SMB.camera.x = cameraX
+    SMB.level.update(frameTime)
+
+def enemy (tile, x, state):
+    entity = SMB.level.makeEnemy(tile, x, groundY - SMB.tileWidth)
+    SMB.level.addEntity(entity)
+    entity.changeState(state)
+    return entity
+
+####################################
+# Tests
+####################################
+
+# DespawnTest
+# Entities that leave the level must not be acted on through contacts
+# they made before they left.
+class DespawnTest (unittest.TestCase):
+    def setUp (self):
+        start()
+
+    def testShellHitsDespawnedGoomba (self):
+        # A stomped goomba and a shell overlap at the left of the window,
+        # then the camera moves on so only the goomba falls behind it.
+        cameraX = 1000
+        left = cameraX - SMB.options.simulation_margin
+        update(cameraX)
+        goomba = enemy(SMB.goombaTile, left - SMB.tileWidth + 10, "stomped")
+        shell = enemy(SMB.koopaTile, left - 30, "stomped")
+        shell.direction = "right"
+        shell.changeState("shellMove")
+        update(cameraX)
+        self.assertIn(goomba, shell.collidingObjects)
+
+        update(cameraX + 20)
+        self.assertNotIn(goomba, SMB.level.entities)
+        self.assertIn(shell, SMB.level.entities)
+
+    def testRemoveTwice (self):
+        update(1000)
+        goomba = enemy(SMB.goombaTile, 1200, "move")
+        SMB.level.removeEntity(goomba)
+        SMB.level.removeEntity(goomba)
+        self.assertNotIn(goomba, SMB.level.entities)
+
+if __name__ == "__main__":
+    unittest.main()